@@ -3,7 +3,7 @@ import math
 import gc
 from typing import Iterable
 from itertools import islice
-from searcharray.phrase.middle_out import MAX_POSN, PosnBitArrayFromFlatBuilder, PosnBitArrayBuilder, PosnBitArrayAlreadyEncBuilder
+from searcharray.phrase.middle_out import MAX_POSN, PosnBitArray, PosnBitArrayFromFlatBuilder, PosnBitArrayBuilder, PosnBitArrayAlreadyEncBuilder
 from searcharray.term_dict import TermDict
 from searcharray.utils.mat_set import SparseMatSetBuilder
 from searcharray.utils.row_viewable_matrix import RowViewableMatrix
@@ -11,21 +11,13 @@ from searcharray.utils.row_viewable_matrix import RowViewableMatrix
 import logging
 logger = logging.getLogger(__name__)
 
+_32 = np.uint64(32)
+_lower_32 = np.uint64(0xFFFFFFFF)
 
-def _compute_doc_lens(posns: np.ndarray, doc_ids: np.ndarray, num_docs: int) -> np.ndarray:
-    """Given an array of positions, compute the length of each document."""
-    doc_lens = np.zeros(num_docs, dtype=np.uint32)
 
-    # Find were we ave posns for each doc
-    non_empty_doc_lens = -np.diff(posns) + 1
-
-    non_empty_idxs = np.argwhere(non_empty_doc_lens > 0).flatten()
-    non_empty_doc_ids = doc_ids[non_empty_idxs]
-    non_empty_doc_lens = non_empty_doc_lens[non_empty_idxs]
-    doc_lens[non_empty_doc_ids] = non_empty_doc_lens
-    if doc_ids[-1] not in non_empty_doc_ids:
-        doc_lens[doc_ids[-1]] = posns[-1] + 1
-    return doc_lens
+def _compute_doc_lens(doc_ids: np.ndarray, num_docs: int) -> np.ndarray:
+    """Given the doc id of every token (one per posn), compute the length of each document."""
+    return np.bincount(doc_ids, minlength=num_docs).astype(np.uint32)
 
 
 def convert_size(size_bytes):
@@ -39,36 +31,42 @@ def convert_size(size_bytes):
 
 
 def _gather_tokens(array, tokenizer, term_dict, term_doc, start_doc_id=0, trunc_posn=None):
-    all_terms = []
-    all_docs = []
-    all_posns = []
+    # Term ids of every doc, grown by doubling, rather than an array per doc
+    terms_buf = np.empty(max(len(array), 1) * 16, dtype=np.uint32)
+    doc_bounds = np.zeros(len(array) + 1, dtype=np.int64)
+    total = 0
 
     logger.info(f"Tokenizing {len(array)} documents")
 
     for idx, doc in enumerate(array):
-        doc_id = start_doc_id + idx
-
-        terms = np.asarray([term_dict.add_term(token)
-                            for token in tokenizer(doc)], dtype=np.uint32)[:trunc_posn]
-        doc_ids = np.full(len(terms), doc_id, dtype=np.uint32)[:trunc_posn]
-        all_terms.append(terms)
-        all_docs.append(doc_ids)
-
-        all_posns.append(np.arange(len(terms)))
-
-        term_doc.append(np.unique(terms))
+        terms = term_dict.add_terms(tokenizer(doc))[:trunc_posn]
+        end = total + len(terms)
+        if end > len(terms_buf):
+            terms_buf = np.resize(terms_buf, max(end, 2 * len(terms_buf)))
+        terms_buf[total:end] = terms
+        doc_bounds[idx + 1] = end
+        total = end
 
         if idx % 10000 == 0 and idx > 0:
-            logger.info(f"Tokenized {doc_id} ({100.0 * (idx / len(array))}%)")
+            logger.info(f"Tokenized {start_doc_id + idx} ({100.0 * (idx / len(array))}%)")
+
+    # Derive doc ids / posns in one pass from the doc boundaries
+    all_terms = terms_buf[:total]
+    doc_lens = np.diff(doc_bounds)
+    all_docs = np.repeat(np.arange(start_doc_id, start_doc_id + len(array), dtype=np.uint32), doc_lens)
+    all_posns = (np.arange(total, dtype=np.int64) - np.repeat(doc_bounds[:-1], doc_lens)).astype(np.uint32)
 
-    # Flatten each
-    all_terms = np.concatenate(all_terms)
-    all_docs = np.concatenate(all_docs)
-    all_posns = np.concatenate(all_posns)
+    # Each doc's unique terms, for every doc in one sort over (doc, term) rather than per doc
+    doc_terms = np.unique((np.repeat(np.arange(len(array), dtype=np.uint64), doc_lens) << _32)
+                          | all_terms.astype(np.uint64))
+    term_doc.append_rows((doc_terms & _lower_32).astype(np.uint32),
+                         np.bincount((doc_terms >> _32).astype(np.intp), minlength=len(array)))
+    del doc_terms
 
     logger.info("Tokenization -- vstacking")
+    # All uint32, so sorting / gathering below moves half the bytes of int64
     terms_w_posns = np.vstack([all_terms, all_docs, all_posns])
-    del all_terms, all_docs, all_posns
+    del terms_buf, all_terms, all_docs, all_posns
     gc.collect()
     logger.info("Tokenization -- DONE")
     return terms_w_posns, term_dict, term_doc
@@ -100,8 +98,7 @@ def _tokenize_batch(array, tokenizer, term_dict, term_doc, batch_size, batch_beg
                                                         trunc_posn=trunc_posn)
 
     # Use posns to compute doc lens
-    doc_lens = _compute_doc_lens(posns=terms_w_posns[2, :],
-                                 doc_ids=(terms_w_posns[1, :] - batch_beg),
+    doc_lens = _compute_doc_lens(doc_ids=(terms_w_posns[1, :] - batch_beg),
                                  num_docs=len(array))
     logger.info("Inverting docs->terms")
     terms_w_posns = _invert_docs_terms(terms_w_posns)
@@ -139,39 +136,39 @@ def build_index_from_tokenizer(array: Iterable, tokenizer, batch_size=10000, tru
     term_dict = TermDict()
     term_doc = SparseMatSetBuilder()
     doc_lens = []
-    bit_posns = None
-    batch_bit_posns = None
+    batch_bit_posns = []
+    bit_posns_nbytes = 0
 
     logger.info("Indexing begins")
 
     for batch_beg, batch in batch_iterator(array, batch_size):
         try:
             logger.info(f"{batch_beg} Batch Start")
-            term_doc, batch_bit_posns, term_dict, batch_doc_lens = _tokenize_batch(batch, tokenizer,
-                                                                                   term_dict, term_doc,
-                                                                                   batch_size, batch_beg,
-                                                                                   truncate=truncate)
+            term_doc, bit_posns, term_dict, batch_doc_lens = _tokenize_batch(batch, tokenizer,
+                                                                             term_dict, term_doc,
+                                                                             batch_size, batch_beg,
+                                                                             truncate=truncate)
         except ValueError as e:
             logger.error(e)
             logger.error(f"Batch {batch_beg} failed to tokenize")
             raise e
 
-        if bit_posns is None:
-            bit_posns = batch_bit_posns
-        else:
-            bit_posns.concat(batch_bit_posns)
+        # Concat all batches once at the end, rather than growing every term's posns per batch
+        batch_bit_posns.append(bit_posns)
+        bit_posns_nbytes += bit_posns.nbytes
 
         doc_lens.append(batch_doc_lens)
 
         logger.info(f"{batch_beg} Batch Complete")
-        logger.info(f"Roaringish NBytes -- {convert_size(bit_posns.nbytes)}")
+        logger.info(f"Roaringish NBytes -- {convert_size(bit_posns_nbytes)}")
         logger.info(f"Term Dict Size -- {len(term_dict)}")
 
     doc_lens = np.concatenate(doc_lens)
+    bit_posns = PosnBitArray.concat_many(batch_bit_posns)
 
     avg_doc_length = np.mean(doc_lens)
 
-    return RowViewableMatrix(term_doc.build()), bit_posns, term_dict, avg_doc_length, np.array(doc_lens)
+    return RowViewableMatrix(term_doc.build()), bit_posns, term_dict, avg_doc_length, doc_lens
 
 
 def build_index_from_terms_list(postings, Terms):
@@ -184,12 +181,7 @@ def build_index_from_terms_list(postings, Terms):
     posns = PosnBitArrayBuilder()
     posns_enc = PosnBitArrayAlreadyEncBuilder()
 
-    # COPY 1
-    # Consume generator (tokenized postings) into list
-    # its faster this way?
-    postings = list(postings)
-
-    # COPY 2
+    # Single pass, so consume generators as we go rather than copying into a list first
     for doc_id, tokenized in enumerate(postings):
         if isinstance(tokenized, dict):
             tokenized = Terms(tokenized, doc_len=len(tokenized))
@@ -201,15 +193,20 @@ def build_index_from_terms_list(postings, Terms):
 
         doc_lens.append(tokenized.doc_len)
         avg_doc_length += doc_lens[-1]
-        terms = []
-        for token, term_freq in tokenized.terms():
-            term_id = term_dict.add_term(token)
-            terms.append(term_id)
-            positions = tokenized.positions(token)
-            if positions is not None:
-                posns.add_posns(doc_id, term_id, positions)
-
-        term_doc.append(terms)
+        terms = term_dict.add_terms(tokenized.postings.keys()).tolist()
+        if tokenized.posns is None and posns is not posns_enc:
+            # No positions, just note the terms rather than adding empty posns term by term
+            posns.add_terms(terms)
+        else:
+            add_posns = posns.add_posns
+            term_positions = tokenized.positions
+            for term_id, token in zip(terms, tokenized.postings):
+                positions = term_positions(token)
+                if positions is not None:
+                    add_posns(doc_id, term_id, positions)
+
+        # Rows hold sorted term ids (as the tokenizer path does), so rows compare regardless of dict order
+        term_doc.append(sorted(terms))
 
         posns.ensure_capacity(doc_id)
         num_postings += 1
@@ -118,7 +118,6 @@ def _inner_bigram_freqs(lhs: np.ndarray, rhs: np.ndarray,
 
     """
     lhs_int, rhs_int = encoder.intersect(lhs, rhs)
-    lhs_doc_ids = encoder.keys(lhs_int)
     if len(lhs_int) != len(rhs_int):
         raise ValueError("Encoding error, MSBs apparently are duplicated among your encoded posn arrays.")
     if len(lhs_int) == 0 and cont == Continuation.RHS:
@@ -131,27 +130,28 @@ def _inner_bigram_freqs(lhs: np.ndarray, rhs: np.ndarray,
     # For perf we don't check all values, but if overlapping posns allowed in future, maybe we should
     same_term = (len(lhs_int) == len(rhs_int) and np.all(lhs_int == rhs_int))
     if same_term:
+        lhs_doc_ids = encoder.keys(lhs_int)
         return _inner_bigram_same_term(lhs_int, rhs_int, lhs_doc_ids, phrase_freqs, cont)
 
     rhs_next = None
     lhs_next = None
     overlap_bits = (lhs_int & encoder.payload_lsb_mask) & ((rhs_int & encoder.payload_lsb_mask) >> _1)
 
+    # Only words with some overlap can continue the phrase, a word with no lsbs set
+    # can't match anything in the next bigram, so don't carry it forward
+    matches2 = overlap_bits > 0
+    overlap_bits = overlap_bits[matches2]
     if cont in [Continuation.RHS, Continuation.BOTH]:
         rhs_next = (overlap_bits << _1) & encoder.payload_lsb_mask
-        rhs_next |= (rhs_int & (encoder.key_mask | encoder.payload_msb_mask))
+        rhs_next |= (rhs_int[matches2] & encoder.header_mask)
     if cont in [Continuation.LHS, Continuation.BOTH]:
-        lhs_next = overlap_bits.copy()
-        lhs_next |= (lhs_int & (encoder.key_mask | encoder.payload_msb_mask))
+        lhs_next = overlap_bits | (lhs_int[matches2] & encoder.header_mask)
 
-    matches2 = overlap_bits > 0
-    if np.any(matches2):
-        transitions = np.argwhere(np.diff(lhs_doc_ids[matches2]) != 0).flatten() + 1
-        transitions = np.insert(transitions, 0, 0)
-        counted_bits = popcount64(overlap_bits[matches2])
-        reduced = np.add.reduceat(counted_bits,
-                                  transitions)
-        phrase_freqs[np.unique(lhs_doc_ids[matches2])] += reduced
+    if len(overlap_bits) > 0:
+        # Tag overlaps with their doc id, then popcount + sum per doc in one pass
+        overlap_bits |= (lhs_int[matches2] & encoder.key_mask)
+        doc_ids, counts = encoder.num_values_per_key(overlap_bits)
+        phrase_freqs[doc_ids] += counts
     return phrase_freqs, (lhs_next, rhs_next)
 
 
@@ -167,11 +167,10 @@ def _adjacent_bigram_freqs(lhs: np.ndarray, rhs: np.ndarray,
 
     """
     lhs_int, rhs_int = encoder.intersect_rshift(lhs, rhs, rshift=_neg1)
-    lhs_doc_ids = encoder.keys(lhs_int)
     # lhs lsb set and rhs lsb's most significant bit set
     matches = ((lhs_int & _upper_bit) != 0) & ((rhs_int & _1) != 0)
-    unique, counts = np.unique(lhs_doc_ids[matches], return_counts=True)
-    phrase_freqs[unique] += counts
+    # At most one match per word pair, so count each matching word once (no sort needed)
+    np.add.at(phrase_freqs, encoder.keys(lhs_int[matches]), 1)
     # Set lsb to 0 where no match, lsb to 1 where match
     rhs_next = None if cont == Continuation.LHS else np.asarray([], dtype=np.uint64)
     lhs_next = None if cont == Continuation.RHS else np.asarray([], dtype=np.uint64)
@@ -6,14 +6,13 @@ https://colab.research.google.com/drive/10tIEkdlCE_1J_CcgEcV0jkLfBc-0H4am?authus
 
 """
 import numpy as np
-from copy import deepcopy
-from typing import List, Tuple, Dict, Union, cast, Optional
+from typing import List, Tuple, Dict, Set, Union, cast, Optional, Literal
 from searcharray.roaringish import RoaringishEncoder, convert_keys, merge
 from searcharray.phrase.bigram_freqs import bigram_freqs, Continuation
 from searcharray.phrase.spans import span_search
 import numbers
+import pathlib
 import logging
-from collections import defaultdict
 
 
 logger = logging.getLogger(__name__)
@@ -90,9 +89,6 @@ def _compute_phrase_freqs_rhs(encoded_posns: List[np.ndarray],
         assert conts[1] is not None
         lhs = conts[1]
         mask &= (phrase_freqs > 0)
-        # print("-- pf", phrase_freqs)
-        # dec = encoder.decode(lhs)
-        # print("-- co", dec)
     phrase_freqs[~mask] = 0
     return phrase_freqs
 
@@ -117,9 +113,6 @@ def _compute_phrase_freqs_lhs(encoded_posns: List[np.ndarray],
         assert conts[0] is not None
         rhs = conts[0]
         mask &= (phrase_freqs > 0)
-        # print("-- pf", phrase_freqs)
-        # dec = encoder.decode(lhs)
-        # print("-- co", dec)
     phrase_freqs[~mask] = 0
     return phrase_freqs
 
@@ -165,9 +158,9 @@ class PosnBitArrayFromFlatBuilder:
                                           np.asarray([len(self.flat_array[1])], dtype=np.uint64)])
         term_boundaries = term_boundaries.view(np.uint64)
 
-        encoded, enc_term_boundaries = encoder.encode(keys=self.flat_array[1].view(np.uint64),
+        encoded, enc_term_boundaries = encoder.encode(keys=self.flat_array[1].astype(np.uint64),
                                                       boundaries=term_boundaries[:-1],
-                                                      payload=self.flat_array[2].view(np.uint64))
+                                                      payload=self.flat_array[2].astype(np.uint64))
         term_ids = self.flat_array[0][term_boundaries[:-1]]
 
         encoded_term_posns = {}
@@ -179,33 +172,64 @@ class PosnBitArrayFromFlatBuilder:
 
 
 class PosnBitArrayBuilder:
+    """Accumulate flat (term id, doc id, posn) triplets, then encode every term in one pass.
+
+    Term / doc ids are stored once per add_posns call (with a run length), not once per posn.
+    """
 
     def __init__(self):
-        self.term_posns = defaultdict(list)
-        self.term_posn_doc_ids = defaultdict(list)
+        self.term_ids: List[int] = []
+        self.doc_ids: List[int] = []
+        self.run_lens: List[int] = []
+        self.posns: List[int] = []
+        self.seen_term_ids: Set[int] = set()
         self.max_doc_id = 0
 
     def add_posns(self, doc_id: int, term_id: int, posns: List[int]):
-        doc_ids = [doc_id] * len(posns)
-        self.term_posns[term_id].extend(posns)
-        self.term_posn_doc_ids[term_id].extend(doc_ids)
+        self.seen_term_ids.add(term_id)
+        self.term_ids.append(term_id)
+        self.doc_ids.append(doc_id)
+        self.run_lens.append(len(posns))
+        self.posns.extend(posns)
+
+    def add_terms(self, term_ids: List[int]):
+        """Note terms present in a doc without positions."""
+        self.seen_term_ids.update(term_ids)
 
     def ensure_capacity(self, doc_id):
         self.max_doc_id = max(self.max_doc_id, doc_id)
 
     def build(self, check=False):
+        run_lens = np.asarray(self.run_lens, dtype=np.int64)
+        term_ids = np.repeat(np.asarray(self.term_ids, dtype=np.uint64), run_lens)
+        doc_ids = np.repeat(np.asarray(self.doc_ids, dtype=np.uint64), run_lens)
+        posns = np.asarray(self.posns, dtype=np.uint64).flatten()
+
+        # Group by term, keeping doc / posn insertion order within each term
+        by_term = np.argsort(term_ids, kind='stable')
+        term_ids = term_ids[by_term]
+        doc_ids = doc_ids[by_term]
+        posns = posns[by_term]
+
         encoded_term_posns = {}
-        for term_id, posns in self.term_posns.items():
-            if len(posns) == 0:
-                posns = np.asarray([], dtype=np.uint32).flatten()
-            elif isinstance(posns, list):
-                posns_arr = np.asarray(posns, dtype=np.uint32).flatten()
-                posns = posns_arr
-            doc_ids = self.term_posn_doc_ids[term_id]
-            if isinstance(doc_ids, list):
-                doc_ids = np.asarray(doc_ids, dtype=np.uint32)
-            encoded = encoder.encode(keys=doc_ids, payload=posns)
-            if check:
+        if len(term_ids) > 0:
+            term_boundaries = np.argwhere(np.diff(term_ids) > 0).flatten() + 1
+            term_boundaries = np.concatenate([[_0], term_boundaries.view(np.uint64)], dtype=np.uint64)
+            encoded, enc_term_boundaries = encoder.encode(keys=doc_ids,
+                                                          boundaries=term_boundaries,
+                                                          payload=posns)
+            for into_terms, (beg_idx, end_idx) in enumerate(zip(enc_term_boundaries[:-1],
+                                                                enc_term_boundaries[1:])):
+                term_id = int(term_ids[term_boundaries[into_terms]])
+                encoded_term_posns[term_id] = encoded[beg_idx:end_idx]
+
+        # Terms added with no positions still get an (empty) entry
+        for term_id in self.seen_term_ids.difference(encoded_term_posns.keys()):
+            encoded_term_posns[term_id] = np.asarray([], dtype=np.uint64)
+
+        if check:
+            for term_id, encoded in encoded_term_posns.items():
+                term_mask = term_ids == term_id
                 decode_again = encoder.decode(encoded)
                 docs_to_posns = dict(decode_again)
                 doc_ids_again = []
@@ -214,9 +238,8 @@ class PosnBitArrayBuilder:
                     for posn in posns_dec:
                         doc_ids_again.append(doc_id)
                         posns_again.append(posn)
-                assert np.array_equal(doc_ids_again, doc_ids)
-                assert np.array_equal(posns, posns_again)
-            encoded_term_posns[term_id] = encoded
+                assert np.array_equal(doc_ids_again, doc_ids[term_mask])
+                assert np.array_equal(posns_again, posns[term_mask])
 
         return PosnBitArray(encoded_term_posns, self.max_doc_id)
 
@@ -248,16 +271,20 @@ def index_range(rng, key):
     elif isinstance(key, numbers.Number):
         return rng[key]
     elif isinstance(key, np.ndarray):
-        try:
-            # UNFORTUNATE COPY
-            r_val = np.asarray(list(rng))[key]
-            return r_val
-        except IndexError as e:
-            raise e
+        # Index arithmetically, rather than materializing the range
+        if key.dtype == bool:
+            if len(key) != len(rng):
+                raise IndexError(f"Boolean index of length {len(key)} does not match range of length {len(rng)}")
+            idx = np.flatnonzero(key)
+        else:
+            idx = key.astype(np.int64)
+            idx[idx < 0] += len(rng)
+            if np.any((idx < 0) | (idx >= len(rng))):
+                raise IndexError(f"Index out of bounds for range of length {len(rng)}")
+        return rng.start + rng.step * idx
     # Last resort
-    # UNFORTUNATE COPY
     # Here probably elipses or a tuple of various things
-    return np.asarray(list(rng))[key]
+    return np.arange(rng.start, rng.stop, rng.step)[key]
 
 
 class PosnBitArray:
@@ -280,9 +307,43 @@ class PosnBitArray:
         self.termfreq_cache = {}
 
     def copy(self):
-        new = PosnBitArray(deepcopy(self.encoded_term_posns), self.max_doc_id)
+        new = PosnBitArray({term_id: encoded.copy() for term_id, encoded in self.encoded_term_posns.items()},
+                           self.max_doc_id)
         return new
 
+    def save(self, path):
+        """Save to a directory, all terms' posns in one flat .npy file."""
+        path = pathlib.Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        term_ids = np.fromiter(self.encoded_term_posns.keys(), dtype=np.uint32,
+                               count=len(self.encoded_term_posns))
+        lengths = np.fromiter((len(encoded) for encoded in self.encoded_term_posns.values()),
+                              dtype=np.int64, count=len(self.encoded_term_posns))
+        boundaries = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=boundaries[1:])
+        posns = np.concatenate([np.asarray([], dtype=np.uint64)] + list(self.encoded_term_posns.values()),
+                               dtype=np.uint64)
+        np.save(path / "posns.npy", posns)
+        np.save(path / "term_ids.npy", term_ids)
+        np.save(path / "boundaries.npy", boundaries)
+        np.save(path / "max_doc_id.npy", np.asarray(self.max_doc_id, dtype=np.int64))
+
+    @classmethod
+    def load(cls, path, mmap_mode: Optional[Literal['r+', 'r', 'c']] = 'c') -> 'PosnBitArray':
+        """Load from a directory written by save.
+
+        By default posns are memory mapped copy-on-write, so they're paged in from disk as
+        terms are used (the Cython kernels need writable buffers, so not 'r').
+        """
+        path = pathlib.Path(path)
+        posns = np.load(path / "posns.npy", mmap_mode=mmap_mode)
+        term_ids = np.load(path / "term_ids.npy").tolist()
+        boundaries = np.load(path / "boundaries.npy").tolist()
+        max_doc_id = int(np.load(path / "max_doc_id.npy"))
+        encoded_term_posns = {term_id: posns[beg:end]
+                              for term_id, beg, end in zip(term_ids, boundaries[:-1], boundaries[1:])}
+        return cls(encoded_term_posns, max_doc_id)
+
     def concat(self, other):
         """Merge other into self.
 
@@ -301,13 +362,30 @@ class PosnBitArray:
         self.max_doc_id = max(self.max_doc_id, other.max_doc_id)
         self.clear_cache()
 
+    @classmethod
+    def concat_many(cls, arrs: List['PosnBitArray']) -> 'PosnBitArray':
+        """Concatenate many arrays at once, each term's posns copied only once.
+
+        Assumes arrs are in doc id order, with no overlapping doc ids.
+        """
+        to_concat: Dict[int, List[np.ndarray]] = {}
+        for arr in arrs:
+            for term_id, encoded in arr.encoded_term_posns.items():
+                try:
+                    to_concat[term_id].append(encoded)
+                except KeyError:
+                    to_concat[term_id] = [encoded]
+        encoded_term_posns = {term_id: (encoded[0] if len(encoded) == 1 else np.concatenate(encoded))
+                              for term_id, encoded in to_concat.items()}
+        max_doc_id = max((arr.max_doc_id for arr in arrs), default=0)
+        return cls(encoded_term_posns, max_doc_id)
+
     def slice(self, key):
         sliced_term_posns = {}
-        doc_ids = convert_keys(key)
+        # Sort (and dedup) once, rather than relying on each term's slice
+        doc_ids = np.unique(convert_keys(key))
         max_doc_id = np.max(doc_ids)
-        for term_id, posns in self.encoded_term_posns.items():
-            encoded = self.encoded_term_posns[term_id]
-            assert len(encoded.shape) == 1
+        for term_id, encoded in self.encoded_term_posns.items():
             sliced_term_posns[term_id] = encoder.slice(encoded, keys=doc_ids)
 
         return PosnBitArray(sliced_term_posns, max_doc_id)
@@ -332,9 +410,7 @@ class PosnBitArray:
         self.clear_cache()
 
     def doc_encoded_posns(self, term_id: int, doc_id: int) -> np.ndarray:
-        term_posns = encoder.slice(self.encoded_term_posns[term_id],
-                                   keys=np.asarray([doc_id], dtype=np.uint64))
-        return term_posns
+        return encoder.slice_key(self.encoded_term_posns[term_id], doc_id)
 
     def phrase_freqs(self, term_ids: List[int], phrase_freqs: np.ndarray,
                      doc_ids: np.ndarray,
@@ -423,23 +499,26 @@ class PosnBitArray:
                 self.termfreq_cache[term_id] = (doc_ids, term_freqs)
             return doc_ids, term_freqs
 
+    def _is_common(self, docfreq: np.uint64) -> bool:
+        return bool(self.max_doc_id >= 99999 and docfreq > (self.max_doc_id // 100))
+
     def _is_cached(self, term_id: int) -> bool:
-        return term_id in self.docfreq_cache
+        # Only common terms are worth holding term freqs for
+        docfreq = self.docfreq_cache.get(term_id)
+        return docfreq is not None and self._is_common(docfreq)
 
     def _docfreq_from_cache(self, term_id: int) -> np.uint64:
         return self.docfreq_cache[term_id]
 
-    def _maybe_cache_docfreq(self, term_id: int, docfreq: np.uint64):
-        if self.max_doc_id >= 99999 and docfreq > (self.max_doc_id // 100):
-            self.docfreq_cache[term_id] = docfreq
-
     def docfreq(self, term_id: int) -> np.uint64:
         try:
             return self.docfreq_cache[term_id]
         except KeyError:
             encoded = self.encoded_term_posns[term_id]
             docfreq = np.uint64(encoder.keys_unique(encoded).size)
-            self._maybe_cache_docfreq(term_id, docfreq)
+            # A scalar per term is cheap to keep, so cache every docfreq
+            # (cleared whenever the posns change)
+            self.docfreq_cache[term_id] = docfreq
             return docfreq
 
     def insert(self, key, term_ids_to_posns, is_encoded=False):
@@ -1,6 +1,7 @@
 """Phrase search by dumb numpy position differences subtraction, bigram by bigram."""
 import numpy as np
 from typing import List
+from searcharray.phrase.posn_merge import bigram_merge
 
 
 def vstack_with_mask(posns: List[np.ndarray], phrase_freqs: np.ndarray, width: int = 0, pad: int = -100):
@@ -19,14 +20,21 @@ def vstack_with_mask(posns: List[np.ndarray], phrase_freqs: np.ndarray, width: i
     vstacked: np.ndarray, vertically stacked arrays of those <= width
     mask: np.ndarray, boolean mask of which arrays were accepted (so you can recompute them a different way)
     """
-    vstacked = np.zeros((len(posns), width), dtype=posns[0].dtype) + pad
+    # Positions are < 2**18 (roaringish payload bits), so int32 holds them and the pad
+    vstacked = np.full((len(posns), width), pad, dtype=np.int32)
     if not isinstance(posns[0], np.ndarray):
         raise TypeError("posns must be a list of np.ndarrays")
-    for idx, array in enumerate(posns):
-        if len(array) >= width:
-            phrase_freqs[idx] = -2  # Mark as skip this round
-        else:
-            vstacked[idx, :len(array)] = array
+    lengths = np.fromiter((len(array) for array in posns), dtype=np.int64, count=len(posns))
+    too_wide = lengths >= width
+    phrase_freqs[too_wide] = -2  # Mark as skip this round
+    accepted = np.flatnonzero(~too_wide)
+    accepted_lengths = lengths[accepted]
+    if accepted_lengths.sum() > 0:
+        # Scatter all accepted positions in one assignment
+        row_idx = np.repeat(accepted, accepted_lengths)
+        row_starts = np.cumsum(accepted_lengths) - accepted_lengths
+        col_idx = np.arange(len(row_idx)) - np.repeat(row_starts, accepted_lengths)
+        vstacked[row_idx, col_idx] = np.concatenate([posns[idx] for idx in accepted])
     return vstacked
 
 
@@ -42,79 +50,62 @@ def stack_term_posns(term_posns: List[List[np.ndarray]], phrase_freqs: np.ndarra
 
 def _compute_phrase_freqs(term_posns, phrase_freqs: np.ndarray, slop=1):
 
-    to_compute = phrase_freqs == -1
+    to_compute = np.flatnonzero(phrase_freqs == -1)
 
-    if not np.any(to_compute):
+    if len(to_compute) == 0:
         return phrase_freqs
 
     # Only examine masked
     term_posns = [term_posn[to_compute] for term_posn in term_posns]
 
+    # Rows of term_posns that could still match the phrase
+    alive = np.arange(len(to_compute))
     prior_term = term_posns[0]
     for term in term_posns[1:]:
+        if len(alive) < len(term):
+            term = term[alive]
         is_same_term = (term.shape == prior_term.shape) and np.all(term == prior_term)
 
-        # Compute positional differences
+        # Count, per doc, the prior_term posns with a term posn slop after them
         #
-        # Each row of posn_diffs is a term posn diff matrix
-        # Where columns are prior_term posns, rows are term posns
-        # This shows every possible term diff
+        # Conceptually, each doc has a posn diff matrix of every term posn minus every
+        # prior_term posn, where we care about diffs == slop (usually slop == 1, ie 1 posn away)
         #
         # Example:
         #   prior_term = array([[0, 4],[0, 4])
         #         term = array([[1, 2, 3],[1, 2, 3]])
         #
-        #
-        #   posn_diffs =
-        #
-        #     array([[ term[0] - prior_term[0], term[0] - prior_term[1] ],
-        #            [ term[1] - prior_term[0], ...
-        #            [ term[2] - prior_term[0], ...
-        #
-        #    or in our example
+        #   posn_diffs (first doc) =
         #
         #     array([[ 1, -3],
         #            [ 2, -2],
         #            [ 3, -1]])
         #
-        #  We care about all locations where posn == slop (or perhaps <= slop)
-        #  that is term is slop away from prior_term. Usually slop == 1 (ie 1 posn away)
-        #  for normal phrase matching
+        # But both rows are sorted, so instead of building that matrix, walk both
+        # rows once, merge style, looking for term == prior_term + slop.
         #
-        posn_diffs = term[:, :, np.newaxis] - prior_term[:, np.newaxis, :]
-
         # For > 2 terms, we need to connect a third term by making prior_term = term
-        # and repeating
+        # and repeating. BUT we only want those parts of term that are adjacent to
+        # prior_term before continuing, so we don't accidentally get a partial phrase.
+        # So the merge also pads out (-100) any posns in 'term' not directly after a
+        # prior_term posn, so they're not considered on subsequent iterations.
         #
-        # BUT
-        # we only want those parts of term that are adjacent to prior_term
-        # before continuing, so we don't accidentally get a partial phrase
-        # so we need to make sure to
-        # Pad out any rows in 'term' where posn diff != slop
-        # so they're not considered on subsequent iterations
-        term_mask = np.any(posn_diffs == 1, axis=2)
-        term[~term_mask] = -100
-
-        # Count how many times the row term is 1 away from the col term
-        per_doc_diffs = np.sum(posn_diffs == slop, axis=1, dtype=np.int8)
-
-        # Doc-wise sum to get a 'term freq' for the prior_term - term bigram
-        bigram_freqs = np.sum(per_doc_diffs == slop, axis=1)
-        if is_same_term:
-            satisfies_slop = per_doc_diffs == slop
-            consecutive_ones = satisfies_slop[:, 1:] & satisfies_slop[:, :-1]
-            consecutive_ones = np.sum(consecutive_ones, axis=1)
-            # ceiling divide?
-            # Really these show up as
-            # 1 1 1 0 1
-            # we need to treat the 2nd consecutive 1 as 'not a match'
-            # and also update 'term' to not include it
-            bigram_freqs -= -np.floor_divide(consecutive_ones, -2)
+        # When the terms are the same, runs like 1 1 1 0 1 overlap themselves, so
+        # the 2nd consecutive match is treated as 'not a match'
+        bigram_freqs = bigram_merge(prior_term, term, slop, is_same_term)
 
         # Last loop, bigram_freqs is the full phrase term freq
 
         # Update mask to eliminate any non-matches
-        phrase_freqs[to_compute] = bigram_freqs
+        phrase_freqs[to_compute[alive]] = bigram_freqs
+
+        # Docs missing this bigram can't match the phrase, stop examining them
+        has_bigram = bigram_freqs > 0
+        if not np.all(has_bigram):
+            alive = alive[has_bigram]
+            if len(alive) == 0:
+                break
+            term = term[has_bigram]
 
         # Should only keep positions of 'prior term' that are adjacent to the
         # one prior to it...
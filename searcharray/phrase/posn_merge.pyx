@@ -0,0 +1,74 @@
+# cython: boundscheck=False
+# cython: wraparound=False
+# cython: initializedcheck=False
+# cython: cdivision=True
+# cython: nonecheck=False
+# cython: language_level=3
+"""Merge padded rows of sorted positions, doc by doc, to count bigrams."""
+cimport numpy as np
+import numpy as np
+
+
+# For each doc (row) of prior / term positions (sorted, negative where padded or dropped)
+# count the prior positions with a term position slop after them, walking both rows
+# once rather than comparing every pair.
+#
+# Then drop (set to -100) every term position not directly after a prior position,
+# so the next term only continues phrases that matched so far.
+cdef _bigram_merge(np.int32_t[:, :] prior,
+                   np.int32_t[:, :] term,
+                   np.int32_t slop,
+                   bint is_same_term,
+                   np.int64_t[:] bigram_freqs):
+    cdef np.intp_t num_docs = prior.shape[0]
+    cdef np.intp_t prior_width = prior.shape[1]
+    cdef np.intp_t term_width = term.shape[1]
+    cdef np.intp_t doc = 0
+    cdef np.intp_t i = 0
+    cdef np.intp_t j = 0
+    cdef np.int32_t target = 0
+    cdef np.int64_t count = 0
+    cdef np.int64_t consecutive = 0
+    cdef bint satisfies = False
+    cdef bint last_satisfies = False
+
+    with nogil:
+        for doc in range(num_docs):
+            count = 0
+            consecutive = 0
+            last_satisfies = False
+            j = 0
+            for i in range(prior_width):
+                satisfies = False
+                if prior[doc, i] >= 0:
+                    target = prior[doc, i] + slop
+                    while j < term_width and term[doc, j] < target:
+                        j += 1
+                    satisfies = j < term_width and term[doc, j] == target
+                if satisfies:
+                    count += 1
+                    if last_satisfies:
+                        consecutive += 1
+                last_satisfies = satisfies
+            if is_same_term:
+                # Runs like 1 1 1 0 1 overlap themselves, every 2nd consecutive
+                # match is not a match
+                count -= (consecutive + 1) // 2
+            bigram_freqs[doc] = count
+
+            i = 0
+            for j in range(term_width):
+                if term[doc, j] < 0:
+                    continue
+                target = term[doc, j] - 1
+                while i < prior_width and prior[doc, i] < target:
+                    i += 1
+                if not (i < prior_width and prior[doc, i] == target):
+                    term[doc, j] = -100
+
+
+def bigram_merge(prior, term, slop, is_same_term):
+    """Count bigram freqs per row of padded positions, dropping unmatched term posns in place."""
+    bigram_freqs = np.empty(prior.shape[0], dtype=np.int64)
+    _bigram_merge(prior, term, slop, is_same_term, bigram_freqs)
+    return bigram_freqs
@@ -4,20 +4,21 @@ import numbers
 from pandas.api.extensions import ExtensionDtype, ExtensionArray, register_extension_dtype
 from pandas.api.types import is_list_like
 from pandas.api.extensions import take
-import json
 from collections import Counter
 import warnings
 import logging
-from typing import List, Union, Optional, Iterable
+from typing import Dict, List, Union, Optional, Iterable, Tuple
 
 
 import numpy as np
 from searcharray.phrase.scan_merge import scan_merge_ins
 from searcharray.phrase.posn_diffs import compute_phrase_freqs
 from searcharray.phrase.middle_out import PosnBitArray
-from searcharray.similarity import Similarity, default_bm25
+from searcharray.similarity import Similarity, default_bm25, invalidate_doc_lens
 from searcharray.indexing import build_index_from_tokenizer, build_index_from_terms_list
 from searcharray.term_dict import TermMissingError
+from searcharray.utils.mat_set import SparseMatSet, SparseMatSetBuilder
+from searcharray.utils.row_viewable_matrix import rowwise_eq, rowwise_hash
 from searcharray.roaringish.roaringish_ops import as_dense
 
 logger = logging.getLogger(__name__)
@@ -106,31 +107,27 @@ class Terms:
             return True
 
     def __lt__(self, other):
-        # return isinstance(other, Terms) and hash(self) < hash(other)
-        keys_both = set(self.postings.keys()).union(set(other.postings.keys()))
-        # Sort lexically
-        keys_both = sorted(keys_both)
-
-        # Iterate as if these are two vectors of the same large dimensional vector sparse
-        for key in keys_both:
-            lhs_val = 0
-            rhs_val = 0
-            try:
-                lhs_val = self.postings[key]
-            except KeyError:
-                pass
-
-            try:
-                rhs_val = other.postings[key]
-            except KeyError:
-                pass
+        # Compare as two sparse vectors over lexically sorted terms (missing terms are 0)
+        # by merging the sorted postings of both sides
+        lhs = sorted(self.postings.items())
+        rhs = sorted(other.postings.items())
+        lhs_idx = rhs_idx = 0
+        while lhs_idx < len(lhs) or rhs_idx < len(rhs):
+            if rhs_idx >= len(rhs) or (lhs_idx < len(lhs) and lhs[lhs_idx][0] < rhs[rhs_idx][0]):
+                lhs_val, rhs_val = lhs[lhs_idx][1], 0
+                lhs_idx += 1
+            elif lhs_idx >= len(lhs) or rhs[rhs_idx][0] < lhs[lhs_idx][0]:
+                lhs_val, rhs_val = 0, rhs[rhs_idx][1]
+                rhs_idx += 1
+            else:
+                lhs_val, rhs_val = lhs[lhs_idx][1], rhs[rhs_idx][1]
+                lhs_idx += 1
+                rhs_idx += 1
 
             if lhs_val < rhs_val:
                 return True
             elif lhs_val > rhs_val:
                 return False
-            else:
-                continue
         return False
 
     def __le__(self, other):
@@ -140,7 +137,7 @@ class Terms:
         return not (self < other) and self != other
 
     def __hash__(self):
-        return hash(json.dumps(self.postings, sort_keys=True))
+        return hash(frozenset(self.postings.items()))
 
 
 class TermsDtype(ExtensionDtype):
@@ -189,20 +186,36 @@ def ws_tokenizer(string):
     return string.split()
 
 
-def _row_to_postings_row(doc_id, row, doc_len, term_dict, posns: PosnBitArray):
-    tfs = {}
-    labeled_posns = {}
-    for term_idx in row.cols:
-        term = term_dict.get_term(term_idx)
-        tfs[term] = 1
-        enc_term_posns = posns.doc_encoded_posns(term_idx, doc_id=doc_id)
-        labeled_posns[term] = enc_term_posns
+def _row_to_postings_row(doc_id, term_ids, doc_len, term_dict, posns: PosnBitArray):
+    term_ids = term_ids.tolist()
+    terms = term_dict.get_terms(term_ids)
+    tfs = dict.fromkeys(terms, 1)
+    labeled_posns = {term: posns.doc_encoded_posns(term_id, doc_id=doc_id)
+                     for term, term_id in zip(terms, term_ids)}
 
     result = Terms(tfs, posns=labeled_posns,
                    doc_len=doc_len, encoded=True)
     return result
 
 
+def _terms_to_mat_set(values, term_dict) -> SparseMatSet:
+    """Gather the term ids of each Terms as a row of a SparseMatSet (missing values are empty rows)."""
+    builder = SparseMatSetBuilder()
+    for terms in values:
+        if not isinstance(terms, Terms):
+            builder.append([])
+            continue
+        term_ids = []
+        for term, freq in terms.terms():
+            if freq == 0:
+                continue
+            if freq != 1:
+                raise ValueError("This sparse matrix only supports setting 1")
+            term_ids.append(term_dict.get_term_id(term))
+        builder.append(sorted(term_ids))
+    return builder.build()
+
+
 class SearchArray(ExtensionArray):
     """An array of tokenized text (Terms).
 
@@ -262,13 +275,23 @@ class SearchArray(ExtensionArray):
         if autowarm:
             posns.warm()
 
-        postings = cls([], tokenizer=tokenizer, avoid_copies=avoid_copies)
+        return cls._from_index(term_mat, posns, term_dict, avg_doc_length, doc_lens,
+                               corpus_size=len(doc_lens), tokenizer=tokenizer,
+                               avoid_copies=avoid_copies)
+
+    @classmethod
+    def _from_index(cls, term_mat, posns, term_dict, avg_doc_length, doc_lens,
+                    corpus_size, tokenizer=ws_tokenizer, avoid_copies=True) -> 'SearchArray':
+        """Wrap already built index structures, without building an (empty) index first."""
+        postings = cls.__new__(cls)
+        postings.avoid_copies = avoid_copies
+        postings.tokenizer = tokenizer
         postings.term_mat = term_mat
         postings.posns = posns
         postings.term_dict = term_dict
         postings.avg_doc_length = avg_doc_length
         postings.doc_lens = doc_lens
-        postings.corpus_size = len(doc_lens)
+        postings.corpus_size = corpus_size
         return postings
 
     def warm(self):
@@ -303,12 +326,13 @@ class SearchArray(ExtensionArray):
         # Want to take rows of term freqs
         if isinstance(key, numbers.Integral):
             try:
-                rows = self.term_mat[key]
+                # Read the row's term ids straight out of the matrix
+                term_ids = self.term_mat.cols_at(key)
                 doc_len = self.doc_lens[key]
                 doc_id = key
                 if doc_id < 0:
                     doc_id += len(self)
-                return _row_to_postings_row(doc_id, rows[0], doc_len,
+                return _row_to_postings_row(doc_id, term_ids, doc_len,
                                             self.term_dict, self.posns)
             except IndexError:
                 raise IndexError("index out of bounds")
@@ -320,14 +344,9 @@ class SearchArray(ExtensionArray):
             else:
                 sliced_posns = self.posns
 
-            arr = SearchArray([], tokenizer=self.tokenizer)
-            arr.term_mat = sliced_tfs
-            arr.doc_lens = self.doc_lens[key]
-            arr.posns = sliced_posns
-            arr.term_dict = self.term_dict
-            arr.avg_doc_length = self.avg_doc_length
-            arr.corpus_size = self.corpus_size
-            return arr
+            return SearchArray._from_index(sliced_tfs, sliced_posns, self.term_dict,
+                                           self.avg_doc_length, self.doc_lens[key],
+                                           corpus_size=self.corpus_size, tokenizer=self.tokenizer)
 
     def __setitem__(self, key, value):
         """Set an item in the array."""
@@ -351,24 +370,23 @@ class SearchArray(ExtensionArray):
         try:
             is_encoded = False
             posns = None
-            term_mat = np.asarray([])
+            term_mat = SparseMatSet()
             doc_lens = np.asarray([])
             if isinstance(value, float):
-                term_mat = np.asarray([value])
+                term_mat = _terms_to_mat_set([value], self.term_dict)
                 doc_lens = np.asarray([0])
             elif isinstance(value, Terms):
-                term_mat = np.asarray([value.tf_to_dense(self.term_dict)])
+                term_mat = _terms_to_mat_set([value], self.term_dict)
                 doc_lens = np.asarray([value.doc_len])
                 is_encoded = value.encoded
                 posns = [value.raw_positions(self.term_dict)]
             elif isinstance(value, np.ndarray):
-                term_mat = np.asarray([x.tf_to_dense(self.term_dict) for x in value])
+                term_mat = _terms_to_mat_set(value, self.term_dict)
                 doc_lens = np.asarray([x.doc_len for x in value])
                 is_encoded = value[0].encoded if len(value) > 0 else False
                 posns = [x.raw_positions(self.term_dict) for x in value]
-            np.nan_to_num(term_mat, copy=False, nan=0)
             self.term_mat[key] = term_mat
-            self.doc_lens[key] = doc_lens
+            self._set_doc_lens(key, doc_lens)
 
             if posns is not None:
                 self.posns.insert(key, posns, is_encoded)
@@ -378,6 +396,19 @@ class SearchArray(ExtensionArray):
         except TermMissingError:
             self._add_new_terms(key, value)
 
+    def _set_doc_lens(self, key, doc_lens):
+        old_len = self.doc_lens[key] if isinstance(key, numbers.Integral) else None
+        self.doc_lens[key] = doc_lens
+        if not self.term_mat.subset and len(self.doc_lens) > 0:
+            # Keep corpus stats in step with the stored doc lengths, a single row
+            # just shifts the average, other keys may repeat rows so recompute
+            if old_len is not None:
+                self.avg_doc_length += (int(self.doc_lens[key]) - int(old_len)) / len(self.doc_lens)
+            else:
+                self.avg_doc_length = np.mean(self.doc_lens)
+        # Written in place, so drop any scoring cached against the old lengths
+        invalidate_doc_lens(self.doc_lens)
+
     def _add_new_terms(self, key, value):
         msg = """Adding new terms! This might not be good if you tokenized this new text
                  with a different tokenizer.
@@ -400,12 +431,53 @@ class SearchArray(ExtensionArray):
         self,
         dropna: bool = True,
     ):
+        # Group rows by their term ids + doc len (what makes two Terms equal), only
+        # materializing a Terms for the first row of each group
+        row_idxs = np.arange(len(self))
         if dropna:
-            counts = Counter(self[:])
-            counts.pop(Terms({}), None)
-        else:
-            counts = Counter(self[:])
-        return pd.Series(counts)
+            row_idxs = row_idxs[~self.isna()]
+        grouped = self._group_rows(row_idxs)
+        if grouped is None:
+            return self._value_counts_by_key(row_idxs)
+        codes, first = grouped
+        return pd.Series(np.bincount(codes, minlength=len(first)),
+                         index=[self[row_idx] for row_idx in row_idxs[first]],
+                         dtype=np.int64)
+
+    def _group_rows(self, row_idxs: np.ndarray) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Group equal rows, numbering groups in order of first appearance.
+
+        Returns each row's group, and where each group first appears in row_idxs
+        (or None on a hash collision).
+        """
+        mat = self.term_mat.mat
+        rows = self.term_mat.rows[row_idxs]
+        doc_lens = self.doc_lens[row_idxs]
+        hashes = rowwise_hash(mat, rows) ^ doc_lens.astype(np.uint64)
+        _, first, groups = np.unique(hashes, return_index=True, return_inverse=True)
+        # Confirm each row equals its group's first row, in case of a hash collision
+        firsts = first[groups]
+        same = rowwise_eq(mat, mat, rows, rows[firsts]) & (doc_lens == doc_lens[firsts])
+        if not np.all(same):
+            return None
+        by_first = np.argsort(first)
+        group_order = np.empty(len(first), dtype=np.intp)
+        group_order[by_first] = np.arange(len(first))
+        return group_order[groups], first[by_first]
+
+    def _value_counts_by_key(self, row_idxs: np.ndarray):
+        mat = self.term_mat.mat
+        begs = mat.rows[self.term_mat.rows[row_idxs]]
+        ends = mat.rows[self.term_mat.rows[row_idxs] + 1]
+        first_rows: Dict[bytes, int] = {}
+        counts: Counter = Counter()
+        for row_idx, beg, end, doc_len in zip(row_idxs, begs, ends, self.doc_lens[row_idxs]):
+            key = np.sort(mat.cols[beg:end]).tobytes() + doc_len.tobytes()
+            first_rows.setdefault(key, row_idx)
+            counts[key] += 1
+        return pd.Series([counts[key] for key in first_rows],
+                         index=[self[row_idx] for row_idx in first_rows.values()],
+                         dtype=np.int64)
 
     def __len__(self):
         len_rval = len(self.term_mat.rows)
@@ -440,9 +512,7 @@ class SearchArray(ExtensionArray):
 
         # When other is a scalar value
         elif isinstance(other, Terms):
-            other = SearchArray([other], tokenizer=self.tokenizer)
-            warnings.warn("Comparing a scalar value to a SearchArray. This is slow.")
-            return np.array(self[:]) == np.array(other[:])
+            return self._eq_terms(other)
 
         # When other is a sequence but not an ExtensionArray
         # its an array of dicts
@@ -459,9 +529,20 @@ class SearchArray(ExtensionArray):
         else:
             return np.full(len(self), False)
 
+    def _eq_terms(self, other: Terms) -> np.ndarray:
+        """Compare every row to one Terms via the term matrix, without boxing each row."""
+        try:
+            other_mat = _terms_to_mat_set([other], self.term_dict)
+        except (TermMissingError, ValueError):
+            # Terms we never indexed (or freqs other than 1) can't equal any row
+            return np.zeros(len(self), dtype=bool)
+        same_terms = rowwise_eq(self.term_mat.mat, other_mat,
+                                self.term_mat.rows, np.zeros(len(self), dtype=np.int64))
+        return same_terms & (self.doc_lens == other.doc_len)
+
     def isna(self):
-        # Every row with all 0s
-        empties = self.doc_lens == 0
+        # Every row with no terms set
+        empties = self.term_mat.cols_per_row() == 0
         return empties
 
     def take(self, indices, allow_fill=False, fill_value=None):
@@ -475,26 +556,28 @@ class SearchArray(ExtensionArray):
                 fill_value = Terms({}, encoded=True)
 
             to_fill_mask = result_indices == -1
-            # This is slow as it rebuilds all the term dictionaries
-            # on the subsequent assignment lines
-            # However, this case tends to be the exception for
-            # most dataframe operations
-            taken = SearchArray([fill_value] * len(result_indices))
-            taken[~to_fill_mask] = self[result_indices[~to_fill_mask]].copy()
-
+            if len(self) == 0:
+                return SearchArray([fill_value] * len(result_indices), tokenizer=self.tokenizer)
+
+            # Take row 0 as a placeholder for fills, then point each fill at its own new empty row
+            taken = self[np.where(to_fill_mask, 0, result_indices)].copy()
+            num_fills = np.sum(to_fill_mask)
+            first_empty_row = len(taken.term_mat.mat)
+            taken.term_mat.mat.ensure_capacity(first_empty_row + num_fills - 1)
+            taken.term_mat.rows[to_fill_mask] = np.arange(first_empty_row, first_empty_row + num_fills)
+            taken.doc_lens[to_fill_mask] = 0
+
+            if fill_value != Terms({}):
+                taken[to_fill_mask] = fill_value
             return taken
         else:
             taken = self[result_indices].copy()
             return taken
 
     def copy(self):
-        postings_arr = SearchArray([], tokenizer=self.tokenizer)
-        postings_arr.doc_lens = self.doc_lens.copy()
-        postings_arr.term_mat = self.term_mat.copy()
-        postings_arr.posns = self.posns
-        postings_arr.term_dict = self.term_dict
-        postings_arr.avg_doc_length = self.avg_doc_length
-        postings_arr.corpus_size = self.corpus_size
+        postings_arr = SearchArray._from_index(self.term_mat.copy(), self.posns, self.term_dict,
+                                               self.avg_doc_length, self.doc_lens.copy(),
+                                               corpus_size=self.corpus_size, tokenizer=self.tokenizer)
 
         if not self.avoid_copies:
             postings_arr.posns = self.posns.copy()
@@ -510,6 +593,19 @@ class SearchArray(ExtensionArray):
     def _from_factorized(cls, values, original):
         return cls(values)
 
+    def factorize(self, use_na_sentinel: bool = True) -> Tuple[np.ndarray, 'SearchArray']:
+        if not use_na_sentinel:
+            return super().factorize(use_na_sentinel=use_na_sentinel)
+        # Group the term matrix rows directly, rather than hashing a Terms per row
+        row_idxs = np.flatnonzero(~self.isna())
+        grouped = self._group_rows(row_idxs)
+        if grouped is None:
+            return super().factorize(use_na_sentinel=use_na_sentinel)
+        row_codes, first = grouped
+        codes = np.full(len(self), -1, dtype=np.intp)
+        codes[row_idxs] = row_codes
+        return codes, self.take(row_idxs[first])
+
     def _values_for_factorize(self):
         """Return an array and missing value suitable for factorization (ie grouping)."""
         arr = np.asarray(self[:], dtype=object)
@@ -544,8 +640,12 @@ class SearchArray(ExtensionArray):
                 slice_of_rows = self.term_mat.rows
                 doc_ids, termfreqs = self.posns.termfreqs(term_id,
                                                           doc_ids=slice_of_rows, min_posn=min_posn, max_posn=max_posn)
-                mask = np.isin(self.term_mat.rows, doc_ids)
-                matches[mask] = termfreqs
+                # Gather each row's tf by looking it up in the (sorted) matching doc ids
+                if len(doc_ids) > 0:
+                    idx = np.searchsorted(doc_ids, slice_of_rows)
+                    idx[idx == len(doc_ids)] = 0
+                    found = doc_ids[idx] == slice_of_rows
+                    matches[found] = termfreqs[idx[found]]
                 return matches
             else:
                 doc_ids, termfreqs = self.posns.termfreqs(term_id,
@@ -610,17 +710,29 @@ class SearchArray(ExtensionArray):
 
     def and_query(self, tokens: Union[List[str], List[List[str]]]) -> np.ndarray:
         """Return a mask on the postings array indicating which elements contain all terms."""
-        masks = [self.match(term) for term in tokens]
+        def rarest_docfreq(term: Union[str, List[str]]) -> int:
+            if isinstance(term, list):
+                return min(self.docfreq(token) for token in term)
+            return self.docfreq(term)
+
+        # Rarest terms first, so we can stop as soon as nothing matches
         mask = np.ones(len(self), dtype=bool)
-        for curr_mask in masks:
-            mask = mask & curr_mask
+        terms: List[Union[str, List[str]]] = list(tokens)
+        for term in sorted(terms, key=rarest_docfreq):
+            mask &= self.match(term)
+            if not mask.any():
+                break
         return mask
 
     def or_query(self, tokens: Union[List[str], List[List[str]]], min_should_match: int = 1) -> np.ndarray:
         """Return a mask on the postings array indicating which elements contain all terms."""
-        masks = [self.match(term) for term in tokens]
-        mask = np.sum(masks, axis=0) >= min_should_match
-        return mask
+        # Count matching terms per row in place, rather than stacking every term's mask
+        num_matches = np.zeros(len(self), dtype=np.int32)
+        for term in tokens:
+            num_matches += self.match(term)
+            if np.all(num_matches >= min_should_match):
+                break
+        return num_matches >= min_should_match
 
     def phrase_freq(self, tokens: List[str],
                     slop=0,
@@ -629,7 +741,7 @@ class SearchArray(ExtensionArray):
         phrase_freqs = np.zeros(len(self))
         try:
             doc_ids = self.term_mat.rows
-            term_ids = [self.term_dict.get_term_id(token) for token in tokens]
+            term_ids = self.term_dict.get_term_ids(tokens).tolist()
             return self.posns.phrase_freqs(term_ids, doc_ids=doc_ids,
                                            phrase_freqs=phrase_freqs,
                                            slop=slop,
@@ -661,11 +773,21 @@ class SearchArray(ExtensionArray):
             return phrase_freqs
 
         term_posns = [self.positions(term, mask) for term in tokens]
+        masked_freqs = phrase_freqs[mask]
         for width in [10, 20, 30, 40]:
-            phrase_freqs[mask] = compute_phrase_freqs(term_posns,
-                                                      phrase_freqs[mask],
-                                                      slop=slop + 1,
-                                                      width=width)
+            # Only restack the rows earlier (narrower) widths couldn't resolve
+            unresolved = np.flatnonzero(masked_freqs == -1)
+            if len(unresolved) == 0:
+                break
+            if len(unresolved) < len(masked_freqs):
+                width_posns = [[posns[idx] for idx in unresolved] for posns in term_posns]
+            else:
+                width_posns = term_posns
+            masked_freqs[unresolved] = compute_phrase_freqs(width_posns,
+                                                            masked_freqs[unresolved],
+                                                            slop=slop + 1,
+                                                            width=width)
+        phrase_freqs[mask] = masked_freqs
 
         remaining_mask = phrase_freqs == -1
         if np.any(remaining_mask):
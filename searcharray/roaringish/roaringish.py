@@ -7,8 +7,8 @@ import logging
 import numbers
 from typing import Optional, Tuple, List, Union
 
-from searcharray.roaringish.snp_ops import intersect, unique, adjacent, merge
-from searcharray.roaringish.roaringish_ops import popcount64_reduce, payload_slice
+from searcharray.roaringish.snp_ops import intersect, unique, adjacent
+from searcharray.roaringish.roaringish_ops import popcount64_reduce, payload_slice, encode, decode
 
 logger = logging.getLogger(__name__)
 
@@ -29,12 +29,16 @@ DEFAULT_PAYLOAD_MSB_BITS = np.uint64(18)
 DEFAULT_PAYLOAD_LSB_MASK = np.uint64(0x000000000003FFFF)
 DEFAULT_PAYLOAD_LSB_BITS = np.uint64(18)
 
+# Below this many keys, slice by binary searching each key
+SMALL_KEYS_SLICE = 32
+
 # To not constantly type coerce
 _64 = np.uint64(64)
 _2 = np.uint64(2)
 _1 = np.uint64(1)
 _0 = np.uint64(0)
 _neg1 = np.int64(-1)
+_no_boundaries = np.asarray([], dtype=np.uint64)
 
 
 def n_msb_mask(n: np.uint64) -> np.uint64:
@@ -101,58 +105,37 @@ class RoaringishEncoder:
         being encoded simultaneously, and we return the boundaries of each
 
         """
-        cols = np.floor_divide(payload, self.payload_lsb_bits, dtype=np.uint64)    # Header of bit to use
-        cols <<= self.payload_msb_bits
-        if keys is not None:
-            cols |= keys.astype(np.uint64) << (_64 - self.key_bits)
-        values = payload % self.payload_lsb_bits   # Value to encode
-
-        change_indices_one_doc = np.nonzero(np.diff(cols))[0] + _1
-        change_indices_one_doc = change_indices_one_doc.view(np.uint64)
-        change_indices_one_doc = np.concatenate([[_0], change_indices_one_doc], dtype=np.uint64)
-        if boundaries is not None:
-            change_indices = merge(change_indices_one_doc, boundaries,
-                                   drop_duplicates=True)
-            new_boundaries = intersect(boundaries,
-                                       change_indices)[-1]
-            new_boundaries = np.concatenate([new_boundaries,
-                                             np.asarray([len(change_indices)], dtype=np.uint64)],
-                                            dtype=np.uint64)
-        else:
-            change_indices = change_indices_one_doc
-            new_boundaries = None
-
         # 0 as a position, goes in bit 1,
         # 1 as a position, goes in bit 2, etc
-        values = _1 << values
-        cols |= values
-        encoded = cols
-        if len(encoded) == 0:
-            return encoded, new_boundaries
-        # All this shitty numpy casting is annoying
-        reduced = np.bitwise_or.reduceat(encoded.view(np.int64), change_indices.view(np.int64))
-        reduced = reduced.view(np.uint64)
-        return reduced, new_boundaries
+        # all OR'd into one word per key + msbs, in one pass over payload
+        payload = payload.astype(np.uint64, copy=False)
+        if keys is None:
+            keys = np.zeros(len(payload), dtype=np.uint64)
+        encoded, new_boundaries = encode(keys.astype(np.uint64, copy=False),
+                                         payload,
+                                         _no_boundaries if boundaries is None else boundaries.astype(np.uint64, copy=False),
+                                         _64 - self.key_bits,
+                                         self.payload_msb_bits,
+                                         self.payload_lsb_bits)
+        if boundaries is None:
+            return encoded, None
+        return encoded, new_boundaries
 
     def decode(self, encoded: np.ndarray, get_keys: bool = True) -> Union[List[Tuple[np.uint64, np.ndarray]], List[np.ndarray]]:
         """Decode an encoded bit array into keys / payloads."""
-        keys = (encoded & self.key_mask) >> (_64 - self.key_bits)
-        msbs = (encoded & self.payload_msb_mask) >> self.payload_msb_bits
-        to_concat = []
-        for bit in range(self.payload_lsb_bits):
-            mask = 1 << bit
-            lsbs = encoded & mask
-            set_lsbs = (lsbs != 0)
-            this_keys = keys[set_lsbs]
-            payload = bit + (msbs[set_lsbs] * self.payload_lsb_bits)
-            doc_with_posn = np.dstack([this_keys, payload])[0]
-            to_concat.append(doc_with_posn)
-
-        stacked = np.vstack(to_concat)
-        # Sort by doc_id, then posn
-        sorted_payload = stacked[np.lexsort((stacked[:, 1], stacked[:, 0]))]
-        keys, idx = np.unique(sorted_payload[:, 0], return_index=True)
-        grouped = np.split(sorted_payload[:, 1], idx[1:])
+        # Walks each word's set bits in order, and encoded is sorted by key then msbs,
+        # so the output is already sorted by key then payload
+        payload_keys, payload = decode(encoded.astype(np.uint64, copy=False),
+                                       _64 - self.key_bits,
+                                       self.payload_msb_mask,
+                                       self.payload_msb_bits,
+                                       self.payload_lsb_mask,
+                                       self.payload_lsb_bits)
+        # Keys are sorted, so groups start wherever the key changes
+        key_starts = np.ones(len(payload_keys), dtype=bool)
+        key_starts[1:] = payload_keys[1:] != payload_keys[:-1]
+        keys = payload_keys[key_starts]
+        grouped = np.split(payload, np.flatnonzero(key_starts)[1:])
         if get_keys:
             return list(zip(keys, grouped))
         else:
@@ -193,8 +176,6 @@ class RoaringishEncoder:
         rhs : np.ndarray of uint64 (encoded) values
         rshift : int how much to shift rhs by to the right
         """
-        # print(lhs, rhs, self.header_mask)
-        # import pdb; pdb.set_trace()
         lhs_idx, rhs_idx = adjacent(lhs, rhs, mask=self.header_mask)
         return lhs[lhs_idx], rhs[rhs_idx]
 
@@ -210,6 +191,13 @@ class RoaringishEncoder:
         lhs_idx, rhs_idx = intersect(lhs, rhs, mask=self.header_mask)
         return lhs[lhs_idx], rhs[rhs_idx]
 
+    def slice_key(self, encoded: np.ndarray, key: int) -> np.ndarray:
+        """Get the encoded words of a single key, a copy of its one contiguous run."""
+        key_start = np.uint64(key) << (_64 - self.key_bits)
+        start = np.searchsorted(encoded, key_start)
+        end = np.searchsorted(encoded, key_start | ~self.key_mask, side='right')
+        return encoded[start:end].copy()
+
     def slice(self,
               encoded: np.ndarray,
               keys: Optional[np.ndarray] = None,
@@ -217,10 +205,22 @@ class RoaringishEncoder:
               min_payload: Optional[int] = None) -> np.ndarray:
         """Get list of encoded that have values in keys."""
         # encoded_keys = encoded.view(np.uint64) >> (_64 - self.key_bits)
-        if keys is not None:
-            encoded_keys = self.keys(encoded)
-            idx_docs, idx_enc = intersect(keys.view(np.uint64),
-                                          encoded_keys.view(np.uint64),
+        if keys is not None and len(keys) <= SMALL_KEYS_SLICE:
+            # Few keys, binary search each key's run of words rather than
+            # computing and intersecting every key in encoded
+            key_shift = _64 - self.key_bits
+            key_starts = np.unique(keys.view(np.uint64)) << key_shift
+            starts = np.searchsorted(encoded, key_starts)
+            ends = np.searchsorted(encoded, key_starts | ~self.key_mask, side='right')
+            lengths = ends - starts
+            idx_enc = np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+            encoded = encoded[idx_enc]
+        elif keys is not None:
+            # Shift the (fewer) keys up into key position and intersect under the key mask,
+            # rather than shifting out every key in encoded
+            idx_docs, idx_enc = intersect(keys.view(np.uint64) << (_64 - self.key_bits),
+                                          encoded,
+                                          mask=self.key_mask,
                                           drop_duplicates=False)
             encoded = encoded[idx_enc]
         if max_payload is None and min_payload is None:
@@ -249,9 +249,6 @@ def convert_keys(keys) -> np.ndarray:
         return np.asarray(keys, dtype=np.uint64)
     elif isinstance(keys, np.ndarray):
         return keys.astype(np.uint64)
-    elif isinstance(keys, range) and len(keys) > 0:
-        # UNFORTUNATE COPY
-        return np.arange(keys[0], keys[-1] + 1, dtype=np.uint64) + keys[0]
     elif isinstance(keys, range):
-        return np.asarray([], dtype=np.uint64)
+        return np.arange(keys.start, keys.stop, keys.step, dtype=np.uint64)
     raise ValueError(f"Unknown type for keys: {type(keys)}")
@@ -21,6 +21,7 @@ cdef extern from "stddef.h":
     # Assuming size_t is available via stddef.h for the example's simplicity
     # and portability, though it's not directly used here.
     int __builtin_popcountll(unsigned long long x)
+    int __builtin_ctzll(unsigned long long x)
 
 # Popcount reduce key-value pair
 # for words 0xKKKKKKKK...KKKKVVVV...VVVV
@@ -32,21 +33,25 @@ cdef _popcount64_reduce(DTYPE_t[:] arr,
                         DTYPE_t value_mask):
     cdef float[:] popcounts = np.zeros(arr.shape[0], dtype=np.float32)
     cdef DTYPE_t[:] keys = np.empty(arr.shape[0], dtype=np.uint64)
-    # cdef int i = 0
     cdef float* popcounts_ptr = &popcounts[0]
     cdef DTYPE_t* keys_ptr = &keys[0]
     cdef DTYPE_t* arr_ptr = &arr[0]
     cdef DTYPE_t last_key = 0xFFFFFFFFFFFFFFFF
+    cdef np.intp_t num_keys = 0
 
     for _ in range(arr.shape[0]):
-        popcounts_ptr[0] += __builtin_popcountll(arr_ptr[0] & value_mask)
-        if arr_ptr[0] >> key_shift != last_key:
+        # Start a new output slot *before* counting, so every word's bits
+        # land with its own key
+        if arr_ptr[0] >> key_shift != last_key or num_keys == 0:
             last_key = arr_ptr[0] >> key_shift
+            if num_keys > 0:
+                popcounts_ptr += 1
+                keys_ptr += 1
             keys_ptr[0] = last_key
-            popcounts_ptr += 1
-            keys_ptr += 1
+            num_keys += 1
+        popcounts_ptr[0] += __builtin_popcountll(arr_ptr[0] & value_mask)
         arr_ptr += 1
-    return keys, popcounts, keys_ptr - &keys[0]
+    return keys, popcounts, num_keys
 
 
 def popcount64_reduce(arr, key_shift, value_mask):
@@ -102,3 +107,99 @@ def as_dense(indices, values, size):
     if len(indices) != len(values):
         raise ValueError("indices and values must have the same length")
     return np.array(_as_dense_array(indices_view, values_view, size))
+
+
+# Encode sorted (key, payload) pairs in one pass
+# into words 0xKKKKKKKK...MMMMMMMM...LLLLLLLL, where consecutive payloads
+# sharing key and msbs (payload // lsb_bits) are OR'd into one word's lsbs.
+# A new word is also started at every index in boundaries, returning
+# where each boundary landed in the output.
+cdef _encode(DTYPE_t[:] keys,
+             DTYPE_t[:] payload,
+             DTYPE_t[:] boundaries,
+             DTYPE_t key_shift,
+             DTYPE_t msb_shift,
+             DTYPE_t lsb_bits):
+    cdef np.intp_t num_payload = payload.shape[0]
+    cdef np.intp_t num_boundaries = boundaries.shape[0]
+    cdef DTYPE_t[:] encoded = np.empty(num_payload, dtype=np.uint64)
+    cdef DTYPE_t[:] new_boundaries = np.empty(num_boundaries + 1, dtype=np.uint64)
+    cdef np.intp_t i = 0
+    cdef np.intp_t i_boundary = 0
+    cdef np.intp_t i_encoded = -1
+    cdef DTYPE_t header = 0
+    cdef DTYPE_t last_header = 0
+    # Sorted payloads mostly share the prior payload's msbs, so only divide
+    # when leaving the current [msb_start, msb_start + lsb_bits) stripe
+    cdef DTYPE_t msbs = 0
+    cdef DTYPE_t msb_start = 0
+    cdef DTYPE_t lsb = 0
+
+    for i in range(num_payload):
+        lsb = payload[i] - msb_start
+        if payload[i] < msb_start or lsb >= lsb_bits:
+            msbs = payload[i] / lsb_bits
+            msb_start = msbs * lsb_bits
+            lsb = payload[i] - msb_start
+        header = (keys[i] << key_shift) | (msbs << msb_shift)
+        if i_encoded < 0 or header != last_header or \
+                (i_boundary < num_boundaries and boundaries[i_boundary] == <DTYPE_t>i):
+            i_encoded += 1
+            encoded[i_encoded] = header
+            last_header = header
+        while i_boundary < num_boundaries and boundaries[i_boundary] == <DTYPE_t>i:
+            new_boundaries[i_boundary] = i_encoded
+            i_boundary += 1
+        encoded[i_encoded] |= (<DTYPE_t>1) << lsb
+
+    # Any boundaries at (or past) the end
+    while i_boundary <= num_boundaries:
+        new_boundaries[i_boundary] = i_encoded + 1
+        i_boundary += 1
+    return encoded, new_boundaries, i_encoded + 1
+
+
+def encode(keys, payload, boundaries, key_shift, msb_shift, lsb_bits):
+    cdef DTYPE_t[:] keys_view = keys
+    cdef DTYPE_t[:] payload_view = payload
+    cdef DTYPE_t[:] boundaries_view = boundaries
+    encoded, new_boundaries, encoded_len = _encode(keys_view, payload_view, boundaries_view,
+                                                   key_shift, msb_shift, lsb_bits)
+    return np.array(encoded[:encoded_len]), np.array(new_boundaries)
+
+
+# Decode words back into parallel (key, payload) arrays, walking only the
+# set lsb bits of each word (via count trailing zeros)
+cdef _decode(DTYPE_t[:] encoded,
+             DTYPE_t key_shift,
+             DTYPE_t msb_mask,
+             DTYPE_t msb_shift,
+             DTYPE_t lsb_mask,
+             DTYPE_t lsb_bits):
+    cdef np.intp_t num_values = 0
+    cdef np.intp_t i = 0
+    for i in range(encoded.shape[0]):
+        num_values += __builtin_popcountll(encoded[i] & lsb_mask)
+
+    cdef DTYPE_t[:] keys = np.empty(num_values, dtype=np.uint64)
+    cdef DTYPE_t[:] payload = np.empty(num_values, dtype=np.uint64)
+    cdef np.intp_t i_value = 0
+    cdef DTYPE_t key = 0
+    cdef DTYPE_t msb_payload = 0
+    cdef DTYPE_t lsbs = 0
+    for i in range(encoded.shape[0]):
+        key = encoded[i] >> key_shift
+        msb_payload = ((encoded[i] & msb_mask) >> msb_shift) * lsb_bits
+        lsbs = encoded[i] & lsb_mask
+        while lsbs:
+            keys[i_value] = key
+            payload[i_value] = msb_payload + __builtin_ctzll(lsbs)
+            i_value += 1
+            lsbs &= lsbs - 1
+    return keys, payload
+
+
+def decode(encoded, key_shift, msb_mask, msb_shift, lsb_mask, lsb_bits):
+    cdef DTYPE_t[:] encoded_view = encoded
+    keys, payload = _decode(encoded_view, key_shift, msb_mask, msb_shift, lsb_mask, lsb_bits)
+    return np.asarray(keys), np.asarray(payload)
@@ -1,8 +1,21 @@
 """Similarity functions given term stats."""
+import weakref
 from typing import Protocol, Dict, Any
 import numpy as np
 
 
+# Times each doc_lens array (by id) was modified in place, dropped once the array is collected
+_doc_lens_generation: Dict[int, int] = {}
+
+
+def invalidate_doc_lens(doc_lens: np.ndarray):
+    """Mark doc_lens as modified in place, so contexts cached against it are rebuilt."""
+    key = id(doc_lens)
+    if key not in _doc_lens_generation:
+        weakref.finalize(doc_lens, _doc_lens_generation.pop, key, None)
+    _doc_lens_generation[key] = _doc_lens_generation.get(key, 0) + 1
+
+
 class ScoringContext:
     """Scoring context for similarity functions."
 
@@ -17,6 +30,7 @@ class ScoringContext:
         self.doc_lens = doc_lens
         self.avg_doc_lens = avg_doc_lens
         self.num_docs = num_docs
+        self.generation = _doc_lens_generation.get(id(doc_lens), 0)
         self.working: Dict[str, Any] = {}
 
     def same_as(self, other: "ScoringContext") -> bool:
@@ -24,6 +38,7 @@ class ScoringContext:
         if other is None:
             return False
         return (self.doc_lens is other.doc_lens
+                and self.generation == other.generation
                 and self.avg_doc_lens == other.avg_doc_lens
                 and self.num_docs == other.num_docs)
 
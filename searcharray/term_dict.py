@@ -1,4 +1,5 @@
 import sys
+import numpy as np
 
 
 class TermMissingError(KeyError):
@@ -21,6 +22,16 @@ class TermDict:
         self.id_to_terms[term_id] = term
         return term_id
 
+    def add_terms(self, terms) -> np.ndarray:
+        """Add many terms at once, returning their term ids."""
+        terms = list(terms)
+        lookup = self.term_to_ids.get
+        term_ids = [lookup(term) for term in terms]
+        if None in term_ids:
+            term_ids = [self.add_term(term) if term_id is None else term_id
+                        for term, term_id in zip(terms, term_ids)]
+        return np.asarray(term_ids, dtype=np.uint32)
+
     def copy(self):
         new_dict = TermDict()
         new_dict.term_to_ids = dict(self.term_to_ids)
@@ -33,12 +44,26 @@ class TermDict:
         except KeyError:
             raise TermMissingError(f"Term {term} not present in dictionary. Reindex to add.")
 
+    def get_term_ids(self, terms) -> np.ndarray:
+        """Look up the term ids of many terms at once."""
+        lookup = self.term_to_ids
+        try:
+            return np.fromiter((lookup[term] for term in terms), dtype=np.uint32, count=len(terms))
+        except KeyError as e:
+            raise TermMissingError(f"Term {e.args[0]} not present in dictionary. Reindex to add.")
+
     def get_term(self, term_id):
         try:
             return self.id_to_terms[term_id]
         except KeyError:
             raise TermMissingError(f"Term at {term_id} not present in dictionary. Reindex to add.")
 
+    def get_terms(self, term_ids):
+        try:
+            return [self.id_to_terms[term_id] for term_id in term_ids]
+        except KeyError as e:
+            raise TermMissingError(f"Term at {e.args[0]} not present in dictionary. Reindex to add.")
+
     def compatible(self, other) -> bool:
         # Intersect the terms in both dictionaries
         terms_self = list(self.term_to_ids.keys())
@@ -3,19 +3,45 @@ import pandas as pd
 import numbers
 
 
+def _ranges(begs: np.ndarray, lens: np.ndarray) -> np.ndarray:
+    """Concatenated np.arange(beg, beg + len) for every beg / len pair."""
+    begs = begs.astype(np.int64)
+    lens = lens.astype(np.int64)
+    offsets = np.cumsum(lens) - lens
+    return np.arange(np.sum(lens), dtype=np.int64) + np.repeat(begs - offsets, lens)
+
+
 class SparseMatSetBuilder:
 
     def __init__(self):
         self.cols = []
         self.rows = [0]
+        # Cols of earlier rows, already as arrays (from append_rows)
+        self.col_chunks = []
+        self.num_chunked = 0
 
     def append(self, cols):
         self.cols.extend(cols)
-        self.rows.append(len(self.cols))
+        self.rows.append(self.num_chunked + len(self.cols))
         return 0
 
+    def append_rows(self, cols: np.ndarray, row_lens: np.ndarray):
+        """Append many rows at once, each row taking the next row_lens[i] cols."""
+        self._flush()
+        self.col_chunks.append(np.asarray(cols, dtype=np.uint32))
+        self.rows.extend((self.num_chunked + np.cumsum(row_lens)).tolist())
+        self.num_chunked += len(cols)
+
+    def _flush(self):
+        if len(self.cols) > 0:
+            self.col_chunks.append(np.asarray(self.cols, dtype=np.uint32))
+            self.num_chunked += len(self.cols)
+            self.cols = []
+
     def build(self):
-        return SparseMatSet(cols=np.asarray(self.cols, dtype=np.uint32),
+        self._flush()
+        cols = np.concatenate(self.col_chunks) if self.col_chunks else np.asarray([], dtype=np.uint32)
+        return SparseMatSet(cols=cols,
                             rows=np.asarray(self.rows, dtype=np.uint32))
 
 
@@ -49,10 +75,14 @@ class SparseMatSet:
             cols = np.asarray([], dtype=np.uint32)
         return SparseMatSet(cols, rows)
 
+    def cols_at(self, row) -> np.ndarray:
+        """Cols set on a single row, as a view (no copy)."""
+        return self.cols[self.rows[row]:self.rows[row + 1]]
+
     def ensure_capacity(self, row):
         if row >= len(self):
             append_amt = row - (len(self.rows) - 1) + 1
-            new_row_ptrs = [len(self.cols)] * append_amt
+            new_row_ptrs = np.full(append_amt, len(self.cols), dtype=self.rows.dtype)
             self.rows = np.concatenate([self.rows, new_row_ptrs])
 
     def set_cols(self, row, cols, overwrite=False):
@@ -84,8 +114,47 @@ class SparseMatSet:
         else:
             self.rows[row + 1:] += cols_added
 
-    def __setitem__(self, index, value):
+    def _set_rows(self, index, value: 'SparseMatSet'):
+        """Overwrite rows at index with the rows of another SparseMatSet (no dense intermediate)."""
         if isinstance(index, numbers.Integral):
+            index = [index]
+        if len(value) == 1:
+            value_rows = np.zeros(len(index), dtype=np.int64)
+        elif len(value) == len(index):
+            value_rows = np.arange(len(value))
+        else:
+            raise ValueError("Index and value must be same length")
+        if len(index) == 0:
+            return
+        index = np.asarray(index, dtype=np.int64)
+        index = np.where(index < 0, index + len(self), index)
+        self.ensure_capacity(np.max(index))
+
+        # Last write wins when a row is set more than once
+        index, last_set = np.unique(index[::-1], return_index=True)
+        value_rows = value_rows[::-1][last_set]
+
+        # Rebuild cols in one pass (rather than splicing each row into all of cols),
+        # rows not being set keep their cols, just shifted to their new offsets
+        old_lens = np.diff(self.rows).astype(np.int64)
+        new_lens = old_lens.copy()
+        value_begs = value.rows[value_rows]
+        new_lens[index] = value.rows[value_rows + 1].astype(np.int64) - value_begs
+        new_rows = np.concatenate([[0], np.cumsum(new_lens)])
+
+        kept = np.ones(len(old_lens), dtype=bool)
+        kept[index] = False
+        kept = np.flatnonzero(kept)
+        cols = np.empty(new_rows[-1], dtype=np.uint32)
+        cols[_ranges(new_rows[kept], old_lens[kept])] = self.cols[_ranges(self.rows[kept], old_lens[kept])]
+        cols[_ranges(new_rows[index], new_lens[index])] = value.cols[_ranges(value_begs, new_lens[index])]
+        self.cols = cols
+        self.rows = new_rows.astype(np.uint32)
+
+    def __setitem__(self, index, value):
+        if isinstance(value, SparseMatSet):
+            self._set_rows(index, value)
+        elif isinstance(index, numbers.Integral):
             if len(value.shape) == 1:
                 value = value.reshape(1, -1)
             set_rows, set_cols = value.nonzero()
@@ -1,17 +1,54 @@
 import numbers
 import numpy as np
-from searcharray.utils.mat_set import SparseMatSet
+from searcharray.utils.mat_set import SparseMatSet, _ranges
 from typing import Optional, Union, Dict, List
 
 
-def rowwise_eq(mat: SparseMatSet, other: SparseMatSet) -> Union[bool, np.ndarray]:
-    """Check equals on a row-by-row basis."""
-    if len(mat) != len(other):
+def _cols_idx(mat: SparseMatSet, rows: np.ndarray) -> np.ndarray:
+    """Indices into mat.cols of every col of rows, concatenated in row order."""
+    begs = mat.rows[rows].astype(np.int64)
+    return _ranges(begs, mat.rows[rows + 1].astype(np.int64) - begs)
+
+
+def _mix64(x: np.ndarray) -> np.ndarray:
+    """Scramble uint64s (splitmix64 finalizer)."""
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def rowwise_hash(mat: SparseMatSet, rows: np.ndarray) -> np.ndarray:
+    """Hash the set of cols of each of rows (equal rows hash equal, unequal rows rarely collide)."""
+    col_hashes = _mix64(mat.cols[_cols_idx(mat, rows)].astype(np.uint64))
+    num_cols = (mat.rows[rows + 1].astype(np.int64) - mat.rows[rows])
+    # Order independent sum of each row's col hashes (wrapping), via a running sum
+    running = np.concatenate([np.zeros(1, dtype=np.uint64), np.cumsum(col_hashes, dtype=np.uint64)])
+    ends = np.cumsum(num_cols)
+    row_sums = running[ends] - running[ends - num_cols]
+    return _mix64(row_sums + num_cols.astype(np.uint64))
+
+
+def rowwise_eq(mat: SparseMatSet, other: SparseMatSet,
+               rows: Optional[np.ndarray] = None,
+               other_rows: Optional[np.ndarray] = None) -> Union[bool, np.ndarray]:
+    """Check equals on a row-by-row basis (optionally only at rows / other_rows)."""
+    if rows is None:
+        rows = np.arange(len(mat))
+    if other_rows is None:
+        other_rows = np.arange(len(other))
+    if len(rows) != len(other_rows):
         return False
-    row_eq = np.zeros(mat.shape[0], dtype=np.dtype('bool'))
-    for row_idx in range(len(mat)):
-        if np.all(mat[row_idx] == other[row_idx]):
-            row_eq[row_idx] = True
+    num_cols = mat.rows[rows + 1].astype(np.int64) - mat.rows[rows]
+    other_num_cols = other.rows[other_rows + 1].astype(np.int64) - other.rows[other_rows]
+    row_eq = num_cols == other_num_cols
+
+    # Compare the cols of every row with a matching number of cols in one pass
+    same_len = np.argwhere(row_eq).flatten()
+    cols_differ = mat.cols[_cols_idx(mat, rows[same_len])] != other.cols[_cols_idx(other, other_rows[same_len])]
+    row_of_col = np.repeat(same_len, num_cols[same_len])
+    row_eq[row_of_col[cols_differ]] = False
     return row_eq
 
 
@@ -29,6 +66,8 @@ class RowViewableMatrix:
         else:
             self.rows = rows
         self.subset = subset
+        self._col_rows: Optional[np.ndarray] = None
+        self._col_ptrs: Optional[np.ndarray] = None
 
     def slice(self, keys):
         return RowViewableMatrix(self.mat, self.rows[keys], subset=True)
@@ -37,6 +76,8 @@ class RowViewableMatrix:
         # Replace nan with 0
         self.col_cache = {}
         self.cols_cached = []
+        self._col_rows = None
+        self._col_ptrs = None
         actual_keys = self.rows[keys]
         if isinstance(actual_keys, numbers.Integral):
             self.mat[actual_keys] = values
@@ -46,15 +87,36 @@ class RowViewableMatrix:
     def copy_row_at(self, row):
         return self.mat[self.rows[row]]
 
+    def cols_at(self, row) -> np.ndarray:
+        return self.mat.cols_at(self.rows[row])
+
     def copy(self):
         return RowViewableMatrix(self.mat.copy(), self.rows.copy(), subset=self.subset)
 
     def cols_per_row(self):
-        return self.mat[self.rows].num_cols_per_row()
+        # Read straight from the row pointers, no need to gather the rows' cols
+        return (self.mat.rows[self.rows + 1] - self.mat.rows[self.rows]).astype(np.int64)
+
+    def _rows_with_col(self, col) -> np.ndarray:
+        """Rows of the underlying matrix with col set, via a (cached) column-major index."""
+        if self._col_rows is None or self._col_ptrs is None:
+            row_of_each_col = np.repeat(np.arange(len(self.mat), dtype=np.uint32),
+                                        np.diff(self.mat.rows))
+            by_col = np.argsort(self.mat.cols, kind='stable')
+            self._col_rows = row_of_each_col[by_col]
+            self._col_ptrs = np.searchsorted(self.mat.cols[by_col],
+                                             np.arange(self.mat.shape[1] + 2))
+        if col + 1 >= len(self._col_ptrs):
+            return np.asarray([], dtype=np.uint32)
+        return self._col_rows[self._col_ptrs[col]:self._col_ptrs[col + 1]]
 
     def copy_col_at(self, col):
         if col not in self.col_cache:
-            self.col_cache[col] = self.mat[self.rows, col]
+            # Mark rows with col set, then gather through the view (no membership test)
+            has_col = np.zeros(len(self.mat), dtype=np.uint8)
+            has_col[self._rows_with_col(col)] = 1
+            col_vals = has_col[self.rows]
+            self.col_cache[col] = col_vals
             self.cols_cached.append(col)
             if len(self.cols_cached) > 10:
                 del self.col_cache[self.cols_cached.pop(0)]
@@ -88,4 +150,4 @@ class RowViewableMatrix:
         return f"RowViewableMatrix({str(self.mat)}, {str(self.rows)})"
 
     def __eq__(self, other):
-        return rowwise_eq(self.mat[self.rows], other.mat[other.rows])
+        return rowwise_eq(self.mat, other.mat, self.rows, other.rows)
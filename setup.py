@@ -130,7 +130,9 @@ setup(
     install_requires=["pandas>=2.0.0", "Cython"],  # Optional
     include_dirs=[np.get_include()],
     ext_modules=cythonize([Extension("searcharray.roaringish.*",
-                                     ["searcharray/roaringish/*.pyx"])]),
+                                     ["searcharray/roaringish/*.pyx"]),
+                           Extension("searcharray.phrase.*",
+                                     ["searcharray/phrase/*.pyx"])]),
 
     # List additional groups of dependencies here (e.g. development
     # dependencies). Users will be able to install these using the "extras"
@@ -148,7 +150,7 @@ setup(
     # installed, specify them here.
     package_data={
         # Ensure the package name matches your package's actual name
-        'searcharray': ['roaringish/*.pyx', 'roaringish/*.pxd'],
+        'searcharray': ['roaringish/*.pyx', 'roaringish/*.pxd', 'phrase/*.pyx'],
     },
     # Entry points. The following would provide a command called `sample` which
     # executes the function `main` from this package when invoked:
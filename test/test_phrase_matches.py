@@ -1,7 +1,7 @@
 from searcharray.postings import SearchArray
 from test_utils import w_scenarios
 import pytest
-from searcharray.phrase.middle_out import MAX_POSN
+from searcharray.phrase.middle_out import MAX_POSN, PosnBitArray
 import numpy as np
 
 
@@ -286,3 +286,13 @@ def test_positions_mask_single():
     assert len(positions) == 1
     for idx, posn in enumerate(positions):
         assert (posn == [1, 2]).all()
+
+
+def test_posns_save_load(tmp_path):
+    data = SearchArray.index(["foo bar bar baz", "data2", "data3 bar", "bunny funny wunny"] * 25)
+    expected = data.termfreqs(["foo", "bar"])
+    data.posns.save(tmp_path / "posns")
+    data.posns = PosnBitArray.load(tmp_path / "posns")
+    assert isinstance(data.posns.encoded_term_posns[0], np.memmap)
+    assert (data.termfreqs(["foo", "bar"]) == expected).all()
+    assert (data.positions("bar")[0] == [1, 2]).all()
@@ -0,0 +1,40 @@
+import numpy as np
+from searcharray.roaringish import RoaringishEncoder, convert_keys
+from test_utils import w_scenarios
+
+
+scenarios = {
+    "from_zero": {
+        "keys": range(0, 4),
+        "expected": [0, 1, 2, 3],
+    },
+    "nonzero_start": {
+        "keys": range(3, 6),
+        "expected": [3, 4, 5],
+    },
+    "stepped": {
+        "keys": range(2, 9, 3),
+        "expected": [2, 5, 8],
+    },
+    "empty": {
+        "keys": range(5, 5),
+        "expected": [],
+    },
+}
+
+
+@w_scenarios(scenarios)
+def test_convert_keys_range(keys, expected):
+    converted = convert_keys(keys)
+    assert converted.dtype == np.uint64
+    assert converted.tolist() == expected
+
+
+def test_slice_key_matches_slice():
+    encoder = RoaringishEncoder()
+    payload = np.asarray([0, 1, 100, 2, 3, 70000, 5], dtype=np.uint64)
+    keys = np.asarray([0, 0, 0, 2, 2, 2, 5], dtype=np.uint64)
+    encoded, _ = encoder.encode(payload, keys=keys)
+    for key in [0, 1, 2, 5, 6]:
+        expected = encoder.slice(encoded, keys=np.asarray([key], dtype=np.uint64))
+        assert np.array_equal(encoder.slice_key(encoded, key), expected)
@@ -0,0 +1,107 @@
+import numpy as np
+from searcharray.utils.mat_set import SparseMatSetBuilder
+from searcharray.utils.row_viewable_matrix import RowViewableMatrix, rowwise_hash
+from test_utils import w_scenarios
+
+
+def _build(rows):
+    builder = SparseMatSetBuilder()
+    for cols in rows:
+        builder.append(cols)
+    return RowViewableMatrix(builder.build())
+
+
+scenarios = {
+    "all_rows": {
+        "rows": [[0, 1], [1, 2], [2], [0]],
+        "view": slice(None),
+        "col": 0,
+        "expected": [1, 0, 0, 1],
+    },
+    "sliced_rows": {
+        "rows": [[0, 1], [1, 2], [2], [0]],
+        "view": slice(1, None),
+        "col": 2,
+        "expected": [1, 1, 0],
+    },
+    "reordered_rows": {
+        "rows": [[0, 1], [1, 2], [2], [0]],
+        "view": np.asarray([3, 0, 2]),
+        "col": 1,
+        "expected": [0, 1, 0],
+    },
+    "col_not_set": {
+        "rows": [[0, 1], [1, 2], [2], [0]],
+        "view": slice(None),
+        "col": 10,
+        "expected": [0, 0, 0, 0],
+    },
+}
+
+
+@w_scenarios(scenarios)
+def test_copy_col_at(rows, view, col, expected):
+    mat = _build(rows)[view]
+    assert np.all(mat.copy_col_at(col) == expected)
+
+
+def test_copy_col_at_after_set():
+    mat = _build([[0, 1], [1, 2], [2], [0]])
+    assert np.all(mat.copy_col_at(2) == [0, 1, 1, 0])
+    mat[0] = np.asarray([0, 0, 1])
+    assert np.all(mat.copy_col_at(2) == [1, 1, 1, 0])
+
+
+def test_builder_append_rows():
+    builder = SparseMatSetBuilder()
+    builder.append([0, 1])
+    builder.append_rows(np.asarray([1, 2, 2]), np.asarray([2, 0, 1]))
+    builder.append([0])
+    mat = RowViewableMatrix(builder.build())
+    assert np.all(mat.copy_col_at(2) == [0, 1, 0, 1, 0])
+    assert np.all(mat.cols_per_row() == [2, 2, 0, 1, 1])
+
+
+def test_cols_at():
+    mat = _build([[0, 1], [1, 2], [2], []])
+    assert np.all(mat.cols_at(1) == [1, 2])
+    assert np.all(mat.cols_at(-1) == [])
+    assert np.all(mat[np.asarray([2, 0])].cols_at(1) == [0, 1])
+
+
+def test_copy_then_set_leaves_other_intact():
+    mat = _build([[0, 1], [1, 2], [2], [0]])
+    copied = mat.copy()
+    copied[0] = np.asarray([0, 0, 1])
+    assert np.all(mat.cols_at(0) == [0, 1])
+    assert np.all(copied.cols_at(0) == [2])
+    mat[1] = np.asarray([1, 0, 0])
+    assert np.all(mat.cols_at(1) == [0])
+    assert np.all(copied.cols_at(1) == [1, 2])
+
+
+def test_copy_of_slice_independent_of_parent():
+    mat = _build([[0, 1], [1, 2], [2], [0]])
+    copied = mat[0:2].copy()
+    mat[0] = np.asarray([0, 0, 1])
+    assert np.all(copied.cols_at(0) == [0, 1])
+
+
+def test_set_many_rows():
+    mat = _build([[0, 1], [1, 2], [2], [0]])
+    values = SparseMatSetBuilder()
+    for cols in [[2], [0, 1, 2], [1]]:
+        values.append(cols)
+    mat[np.asarray([3, 1, 3])] = values.build()
+    assert np.all(mat.cols_per_row() == [2, 3, 1, 1])
+    assert np.all(mat.cols_at(0) == [0, 1])
+    assert np.all(mat.cols_at(1) == [0, 1, 2])
+    assert np.all(mat.cols_at(3) == [1])
+
+
+def test_rowwise_hash():
+    mat = _build([[0, 1], [1, 2], [0, 1], [], [0], []]).mat
+    hashes = rowwise_hash(mat, np.arange(6))
+    assert hashes[0] == hashes[2]
+    assert hashes[3] == hashes[5]
+    assert len(np.unique(hashes)) == 4
@@ -1,7 +1,7 @@
 """Test postings array search functionality."""
 import numpy as np
 import pytest
-from searcharray.postings import SearchArray
+from searcharray.postings import SearchArray, Terms
 from searcharray.similarity import bm25_similarity
 from test_utils import w_scenarios
 
@@ -27,6 +27,23 @@ def test_term_freqs(data):
     assert (matches == [2, 0, 1, 0] * 25).all()
 
 
+def test_term_freqs_sliced(data):
+    matches = data[1:8].termfreqs("bar")
+    assert (matches == [0, 1, 0, 2, 0, 1, 0]).all()
+
+
+def test_term_freqs_repeated_rows(data):
+    matches = data[[0, 0, 2, 3]].termfreqs("bar")
+    assert (matches == [2, 2, 1, 0]).all()
+
+
+def test_term_freqs_long_docs():
+    long_doc = "foo " + "bar " * 100 + "foo foo"
+    data = SearchArray.index(["foo", long_doc, "foo baz", long_doc])
+    matches = data.termfreqs("foo")
+    assert (matches == [1, 3, 1, 3]).all()
+
+
 def test_doc_freq(data):
     doc_freq = data.docfreq("bar")
     assert doc_freq == (2 * 25)
@@ -34,6 +51,47 @@ def test_doc_freq(data):
     assert doc_freq == 25
 
 
+def test_doc_freq_cached(data):
+    foo_id = data.term_dict.get_term_id("foo")
+    assert data.docfreq("foo") == 25
+    assert data.posns.docfreq_cache[foo_id] == 25
+    # Small corpus, so term freqs are not held on to
+    data.termfreqs("foo")
+    assert foo_id not in data.posns.termfreq_cache
+
+
+def test_eq_scalar_terms(data):
+    assert (data == data[0]).tolist() == [True, False, False, False] * 25
+    assert not (data == Terms({"not_present": 1}, doc_len=1)).any()
+
+
+def test_eq_scalar_terms_unsorted_insertion():
+    data = SearchArray([Terms({"a": 1}, doc_len=1),
+                        Terms({"b": 1, "a": 1}, doc_len=2),
+                        Terms({"c": 1, "b": 1}, doc_len=2)])
+    assert (data == Terms({"a": 1, "b": 1}, doc_len=2)).tolist() == [False, True, False]
+    assert (data == Terms({"b": 1, "c": 1}, doc_len=2)).tolist() == [False, False, True]
+
+
+def test_factorize(data):
+    data[1] = Terms({})
+    codes, uniques = data.factorize()
+    assert (codes[:4] == [0, -1, 1, 2]).all()
+    assert (codes[4:] == [0, 3, 1, 2] * 24).all()
+    assert len(uniques) == 4
+    assert uniques[0] == data[0]
+
+
+def test_na_agrees_with_factorize_and_value_counts(data):
+    data[1] = Terms({}, doc_len=3)
+    assert data.isna()[1]
+    codes, uniques = data.factorize()
+    assert codes[1] == -1
+    assert len(uniques) == 4
+    counts = data.value_counts(dropna=True)
+    assert counts.sum() == len(data) - 1
+
+
 def test_doc_lengths(data):
     doc_lengths = data.doclengths()
     assert doc_lengths.shape == (100,)
@@ -41,6 +99,24 @@ def test_doc_lengths(data):
     assert data.avg_doc_length == 2.5
 
 
+def test_doc_lengths_after_set(data):
+    data[1] = data[0]
+    doc_lengths = data.doclengths()
+    assert (doc_lengths[:4] == [4, 4, 2, 3]).all()
+    assert data.avg_doc_length == pytest.approx(2.53)
+
+
+def test_score_after_swapping_rows(data):
+    data.score("bar")
+    first, second = data[0], data[1]
+    data[0] = second
+    data[1] = first
+    assert data.avg_doc_length == pytest.approx(2.5)
+    # Same average, but the cached length normalization must not be reused
+    uncached = data.score("bar", similarity=bm25_similarity())
+    assert np.isclose(data.score("bar"), uncached).all()
+
+
 def test_sim_change_is_different(data):
     bm25 = data.score("bar")
     custom_bm25 = bm25_similarity(k1=10, b=0.01)
@@ -78,6 +154,11 @@ and_scenarios = {
         "docs": lambda: SearchArray.index(["foo bar bar baz", "data2", "data3 bar", "bunny funny wunny"] * 25),
         "keywords": [["foo", "bar"], "baz"],
         "expected": [True, False, False, False] * 25,
+    },
+    "missing_term": {
+        "docs": lambda: SearchArray.index(["foo bar bar baz", "data2", "data3 bar", "bunny funny wunny"] * 25),
+        "keywords": ["bar", ["foo", "bar"], "not_present"],
+        "expected": [False, False, False, False] * 25,
     }
 }
 
@@ -160,3 +241,35 @@ def test_or_query_copy(docs, keywords, expected, min_should_match):
     expected_sliced = expected[:num_docs // 2]
     matches = sliced.or_query(keywords, min_should_match=min_should_match)
     assert (expected_sliced == matches).all()
+
+
+def test_copy_of_slice_unchanged_by_set(data):
+    first = data[0]
+    copied = data[0:2].copy()
+    data[0] = data[1]
+    assert copied[0] == first
+    assert copied[0] != data[0]
+
+
+def test_take_fill_leaves_source_unchanged(data):
+    num_rows = len(data.term_mat.mat)
+    for _ in range(3):
+        taken = data.take([0, -1], allow_fill=True)
+        assert taken[1] == Terms({})
+    assert len(data.term_mat.mat) == num_rows
+
+
+def test_terms_hash_follows_postings():
+    postings = {"foo": 1}
+    terms = Terms(postings)
+    hash(terms)
+    postings["bar"] = 1
+    assert hash(terms) == hash(Terms({"foo": 1, "bar": 1}))
+
+
+def test_terms_lt_follows_postings():
+    postings = {"foo": 1}
+    terms = Terms(postings)
+    assert not terms < Terms({"foo": 1})
+    postings["foo"] = 0
+    assert terms < Terms({"foo": 1})
@@ -1,92 +1,124 @@
 import pytest
-import gzip
-from time import perf_counter
-import json
+import hashlib
+import itertools
+import os
+import pathlib
+from time import perf_counter_ns, process_time_ns
 import pandas as pd
 import numpy as np
 import sys
+import tracemalloc
+import searcharray
 from searcharray.postings import SearchArray
 from test_utils import Profiler, profile_enabled
 
+try:
+    # ISA-L's gunzip is a few times faster than zlib's, if available
+    from isal import igzip as gzip
+except ImportError:
+    import gzip  # type: ignore
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads  # type: ignore
+
 
 should_profile = '--benchmark-disable' in sys.argv
 
+TMDB_PATH = 'fixtures/tmdb.json.gz'
+
+# Set to only load the first N movies (plus those the tests expect to match)
+TMDB_LIMIT = int(os.environ.get('SEARCHARRAY_TMDB_LIMIT', '0')) or None
+TMDB_KEEP_IDS = ['11', '330459', '76180', '374430']
+
 
 @pytest.fixture(scope="session")
 def tmdb_raw_data():
-    path = 'fixtures/tmdb.json.gz'
-    with gzip.open(path) as f:
-        return json.load(f)
+    with gzip.open(TMDB_PATH) as f:
+        data = json_loads(f.read())
+    if TMDB_LIMIT is None:
+        return data
+    limited = dict(itertools.islice(data.items(), TMDB_LIMIT))
+    limited.update({id: data[id] for id in TMDB_KEEP_IDS if id in data})
+    return limited
+
+
+def _title_overview_df(tmdb_raw_data):
+    # Only pull the two columns, missing either comes back as NaN
+    df = pd.DataFrame.from_records(list(tmdb_raw_data.values()),
+                                   index=list(tmdb_raw_data.keys()),
+                                   columns=['title', 'overview'])
+    return df.fillna('')
 
 
 @pytest.fixture(scope="session")
 def tmdb_pd_data(tmdb_raw_data):
-    ids = tmdb_raw_data.keys()
-    titles = []
-    overviews = []
-    for id in ids:
-        try:
-            titles.append(tmdb_raw_data[id]['title'])
-        except KeyError:
-            titles.append('')
-
-        try:
-            overviews.append(tmdb_raw_data[id]['overview'])
-        except KeyError:
-            overviews.append('')
-
-    assert len(ids) == len(titles) == len(overviews)
-    df = pd.DataFrame({'title': titles, 'overview': overviews, 'doc_id': ids}, index=ids)
+    df = _title_overview_df(tmdb_raw_data)
+    df['doc_id'] = df.index
     return df
 
 
+def _tmdb_cache_path(cache_dir):
+    # Rebuild if the fixture or any searcharray source changes, so a stale
+    # pickle never stands in for the code under test
+    src = pathlib.Path(searcharray.__file__).parent
+    mtimes = [pathlib.Path(TMDB_PATH).stat().st_mtime]
+    mtimes += [path.stat().st_mtime for path in src.rglob('*')
+               if path.suffix in ('.py', '.pyx', '.so')]
+    key = hashlib.sha1(repr((TMDB_LIMIT, sorted(mtimes))).encode()).hexdigest()[:16]
+    return cache_dir / f'tmdb_cache_{key}.pkl'
+
+
 @pytest.fixture(scope="session")
-def tmdb_data(tmdb_pd_data):
-    df = tmdb_pd_data
+def tmdb_data(request):
+    # Kept in pytest's cache dir (.pytest_cache), out of the tracked fixtures
+    cache_path = _tmdb_cache_path(request.config.cache.mkdir('tmdb'))
+    if cache_path.exists():
+        return pd.read_pickle(cache_path)
+
+    # Only parse the raw json on a cache miss
+    df = request.getfixturevalue('tmdb_pd_data')
     indexed = SearchArray.index(df['title'])
     df['title_tokens'] = indexed
 
     indexed = SearchArray.index(df['overview'])
     df['overview_tokens'] = indexed
+    for stale in cache_path.parent.glob('tmdb_cache_*.pkl'):
+        stale.unlink()
+    df.to_pickle(cache_path)
     return df
 
 
-def test_tokenize_tmdb(tmdb_raw_data):
-    ids = tmdb_raw_data.keys()
-    titles = []
-    overviews = []
-    for id in ids:
-        try:
-            titles.append(tmdb_raw_data[id]['title'])
-        except KeyError:
-            titles.append('')
-
-        try:
-            overviews.append(tmdb_raw_data[id]['overview'])
-        except KeyError:
-            overviews.append('')
-
-    assert len(ids) == len(titles) == len(overviews)
-
-    df = pd.DataFrame({'title': titles, 'overview': overviews}, index=ids)
-    # Create tokenized versions of each
-    start = perf_counter()
-    print("Indexing title...")
-    indexed = SearchArray.index(df['title'])
-    stop = perf_counter()
-    df['title_tokens'] = indexed
+def _index_and_report(df, column):
+    # Allocation tracing slows indexing several times over (and the times below),
+    # so only when profiling
+    if should_profile:
+        tracemalloc.start()
+    start, cpu_start = perf_counter_ns(), process_time_ns()
+    print(f"Indexing {column}...")
+    indexed = SearchArray.index(df[column])
+    stop, cpu_stop = perf_counter_ns(), process_time_ns()
     print(f"Memory usage: {indexed.memory_usage()}")
-    print(f"Time: {stop - start}")
+    # cpu well under wall means waiting (IO / GIL), not computing
+    print(f"Time: wall={(stop - start) / 1e6:.2f}ms cpu={(cpu_stop - cpu_start) / 1e6:.2f}ms")
+    if should_profile:
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        print(f"Peak traced memory: {peak}")
+        for stat in snapshot.statistics('lineno')[:5]:
+            print(stat)
+    return indexed
 
-    start = perf_counter()
-    print("Indexing overview...")
-    indexed = SearchArray.index(df['overview'])
-    stop = perf_counter()
-    df['overview_tokens'] = indexed
-    print(f"Memory usage: {indexed.memory_usage()}")
-    print(f"Time: {stop - start}")
 
-    assert len(df) == len(ids)
+def test_tokenize_tmdb(tmdb_raw_data):
+    df = _title_overview_df(tmdb_raw_data)
+    # Create tokenized versions of each
+    df['title_tokens'] = _index_and_report(df, 'title')
+    df['overview_tokens'] = _index_and_report(df, 'overview')
+
+    assert len(df) == len(tmdb_raw_data)
 
 
 def test_slice_then_search(tmdb_data):
@@ -126,12 +158,13 @@ tmdb_phrase_matches = [
 
 
 @pytest.mark.skipif(not profile_enabled, reason="Profiling disabled")
-@pytest.mark.parametrize("phrase,expected_matches", tmdb_phrase_matches)
+@pytest.mark.parametrize("phrase,expected_matches", tmdb_phrase_matches,
+                         ids=[" ".join(phrase) for phrase, _ in tmdb_phrase_matches])
 def test_phrase_match_tmdb(phrase, expected_matches, tmdb_data, benchmark):
     prof = Profiler(benchmark)
     mask = prof.run(tmdb_data['title_tokens'].array.match, phrase)
-    matches = tmdb_data[mask].index.sort_values()
-    assert (matches == expected_matches).all()
+    matches = np.sort(tmdb_data.index.values[mask])
+    assert np.array_equal(matches, expected_matches)
 
 
 @pytest.mark.skipif(not profile_enabled, reason="Profiling disabled")
@@ -210,9 +243,10 @@ def test_gather_results(benchmark, tmdb_data):
 @pytest.mark.skipif(not profile_enabled, reason="Profiling disabled")
 def test_eq_benchmark(benchmark, tmdb_data):
     prof = Profiler(benchmark)
-    idx_again = SearchArray.index(tmdb_data['overview'])
-    compare_amount = 10000
-    results = prof.run(tmdb_data['overview_tokens'][:compare_amount].array.__eq__, idx_again[:compare_amount])
+    compare_amount = min(10000, len(tmdb_data))
+    # Only index the rows compared, the term ids line up as they're assigned in doc order
+    idx_again = SearchArray.index(tmdb_data['overview'].iloc[:compare_amount])
+    results = prof.run(tmdb_data['overview_tokens'][:compare_amount].array.__eq__, idx_again)
     assert np.sum(results) == compare_amount
 
     # eq = benchmark(tmdb_data['overview_tokens'].array.__eq__, idx_again)